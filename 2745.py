@@ -1,5 +1,9 @@
 import asyncio 
-from bleak import BleakClient, BleakError
+import logging
+from bleak import BleakError
+from connection_pool import negotiate_mtu, parse_accuracy, pool
+
+logger = logging.getLogger(__name__)
 
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e" # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
@@ -7,6 +11,7 @@ NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UU
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
 
+
 class BLEConfigurator:
     """BLE Configurator for sensor calibration."""
 
@@ -14,38 +19,41 @@ class BLEConfigurator:
         self.address = address
         self.response_log = [] 
         self.client = None
-        self.accel_calibration_complete = False
+        self.write_len = BLE_GATT_WRITE_LEN
+        self.accel_done = asyncio.Event()
 
     async def nus_data_rcv_handler(self, sender, data):
         """Handle incoming notifications from the BLE device."""
-        decoded_data = data.decode('utf-8').strip()
-        print(f"[Received]: {decoded_data}")
-        self.response_log.append(decoded_data)
-        if "Accel Accuracy" in decoded_data:
-            accuracy = int(decoded_data.split()[-1])
-            if accuracy == 3:
-                print("Accelerometer calibration complete.")
-                self.accel_calibration_complete = True
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[Received]: %s", data.decode('utf-8', errors='ignore').strip())
+        self.response_log.append(bytes(data))
+        # Only accuracy lines matter, skip everything else without decoding it
+        if b"Accuracy" not in data:
+            return
+        if parse_accuracy(data, b"Accel Accuracy") == 3:
+            print("Accelerometer calibration complete.")
+            self.accel_done.set()
 
     async def send_command(self, command):
         """Send a single command to the BLE device."""
-        print(f"[Sending]: {command}")
-        await self.client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
+        logger.debug("[Sending]: %s", command)
+        payload = memoryview((command + '\n').encode())
+        for i in range(0, len(payload), self.write_len):
+            await self.client.write_gatt_char(NUS_RX_UUID, payload[i:i + self.write_len])
         await asyncio.sleep(0.5)
 
     async def run(self):
         """Main function to connect, configure, calibrate, and disconnect."""
-        self.client = BleakClient(self.address)
         try:
-            await self.client.connect()
+            self.client = await pool.get(self.address)
             print("Connected to device.")
+            self.write_len = await negotiate_mtu(self.client)
             await self.client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
             await self.send_command("crt")
             await self.send_command("-f l")
             await self.send_command("-l 1 lpok.bin")
             await self.send_command("actse 52 100")
-            while not self.accel_calibration_complete:
-                await asyncio.sleep(1)
+            await self.accel_done.wait()
             print("Accel calibration complete. Waiting 10 seconds before stopping logging...")
             await asyncio.sleep(10)
             await self.send_command("-l 0")
@@ -53,15 +61,24 @@ class BLEConfigurator:
         except BleakError as e:
             print(f"Error: {e}")
         finally:
-            if self.client.is_connected:
-                await self.client.stop_notify(NUS_TX_UUID)
-                await self.client.disconnect()
-                print("Disconnected.")
+            if self.client is not None:
+                try:
+                    await self.client.stop_notify(NUS_TX_UUID)
+                except Exception:
+                    pass
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
     BLE_MAC_ADDRESS = "C4:13:E5:CD:37:72"
     configurator = BLEConfigurator(BLE_MAC_ADDRESS)
+
+    async def main():
+        try:
+            await configurator.run()
+        finally:
+            await pool.close()
+
     try:
-        asyncio.run(configurator.run())
+        asyncio.run(main())
     except asyncio.CancelledError:
         print("Process interrupted.")
\ No newline at end of file
@@ -1,66 +1,62 @@
 import asyncio
+import logging
 import os
 import re
 import subprocess
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
-from bleak import BleakClient, BleakError
+from bleak import BleakError
+from connection_pool import negotiate_mtu, pool, receive_file
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:  # Fall back to the pandas CSV reader
+    pa = pacsv = None
+
+logger = logging.getLogger(__name__)
 
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"  # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+BLE_CONN_INTERVAL = 0.02  # Approximate BLE connection interval in seconds
+
+# Header that marks the start of valid sensor data in the .bin file
+HEADER_RE = re.compile(
+    rb"1\.0\s+1: Accelerometer \(g\):.*?2: Gyroscope \(dps\):.*?3: IMU Temperature \(C\):",
+    re.DOTALL
+)
+HEADER_ANCHOR = b"1: Accelerometer (g):"
 
 
 class BLEFileHandler:
     def __init__(self, address):
         self.address = address
-        self.output_dir = "output"
+        self.output_dir = os.path.join("output", address.replace(":", ""))
+        self.write_len = BLE_GATT_WRITE_LEN
         os.makedirs(self.output_dir, exist_ok=True)
 
     async def send_command(self, client, command):
         """
         Send a command to the BLE device.
         """
-        print(f"[Sending to {self.address[-5:]}]: {command}")
-        if len(command) <= BLE_GATT_WRITE_LEN:
-            await client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        else:
-            for i in range(0, len(command), BLE_GATT_WRITE_LEN):
-                await client.write_gatt_char(NUS_RX_UUID, command[i:i + BLE_GATT_WRITE_LEN].encode())
-        await asyncio.sleep(0.5)
+        logger.debug("[Sending to %s]: %s", self.address[-5:], command)
+        # Encode once and slice views of the same buffer for each write
+        buf = memoryview((command + '\n').encode())
+        for i in range(0, len(buf), self.write_len):
+            await client.write_gatt_char(NUS_RX_UUID, buf[i:i + self.write_len], response=False)
+        await asyncio.sleep(BLE_CONN_INTERVAL)
 
     async def read_large_binary_file(self, client, file_name, max_size_mb=10):
         """
         Read a large binary file (up to max_size_mb) from the BLE device via notifications.
         """
-        max_size_bytes = max_size_mb * 1024 * 1024
         local_path = os.path.join(self.output_dir, file_name)
-        file_data = bytearray()
-
-        def notification_handler(sender, data):
-            nonlocal file_data
-            decoded_data = data.decode(errors="ignore").strip()
-            if not decoded_data.startswith(("rd", "Executing rd")):
-                file_data.extend(data)
-                print(f"Received {len(data)} bytes of file data. Total: {len(file_data)} bytes.")
-            else:
-                print(f"Filtered out log message: {decoded_data}")
         print(f"Requesting file {file_name} from BLE device...")
-        await client.start_notify(NUS_TX_UUID, notification_handler)
-        await client.write_gatt_char(NUS_RX_UUID, f"rd {file_name}\n".encode())
-        timeout = 30
-        for _ in range(timeout):
-            await asyncio.sleep(1)
-            if len(file_data) >= max_size_bytes:
-                print(f"File transfer limit of {max_size_mb} MB reached. Stopping...")
-                break
-        await client.stop_notify(NUS_TX_UUID)
-        with open(local_path, "wb") as f:
-            f.write(file_data)
-        print(f"File saved to {local_path} ({len(file_data)} bytes received)")
+        self.total_bytes = await receive_file(client, local_path, file_name, max_size_mb=max_size_mb, response=False)
         return local_path
 
     def clean_bin_file(self, bin_file):
@@ -70,12 +66,9 @@ class BLEFileHandler:
         print(f"Cleaning binary file: {bin_file}...")
         with open(bin_file, "rb") as f:
             content = f.read()
-        decoded_content = content.decode(errors="ignore")
-        match = re.search(
-            r"1\.0\s+1: Accelerometer \(g\):.*?2: Gyroscope \(dps\):.*?3: IMU Temperature \(C\):", 
-            decoded_content,
-            re.DOTALL
-        )
+        # Locate the literal header text first so the regex only scans from there
+        anchor = content.find(HEADER_ANCHOR)
+        match = HEADER_RE.search(content, max(0, anchor - 64)) if anchor >= 0 else None
         if match:
             valid_start = match.start()
             valid_content = content[valid_start:]
@@ -96,13 +89,15 @@ class BLEFileHandler:
         print(f"Converting {bin_file} to CSV using {exe_path}...")
         try:
             # Use subprocess to run udf2csv.exe
+            # Only stderr is needed, and only when the conversion fails
             result = subprocess.run(
                 [exe_path, bin_file],
-                capture_output=True,
-                text=True
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=False
             )
             if result.returncode != 0:
-                print(f"Error during conversion: {result.stderr}")
+                print(f"Error during conversion: {result.stderr.decode(errors='ignore')}")
                 raise RuntimeError("Failed to convert .bin to .csv")
             print(f"CSV file created: {csv_file}")
             return csv_file
@@ -110,42 +105,60 @@ class BLEFileHandler:
             print(f"Error during conversion: {e}")
             raise
 
+    def read_columns(self, csv_file, columns):
+        """
+        Load only the given columns of the CSV as numbers, matching header names after stripping.
+        Non-numeric cells become NaN.
+        """
+        header = pd.read_csv(csv_file, nrows=0).columns
+        names = [col for col in header if col.strip() in columns]
+        if pacsv is not None:
+            # Read as text so a malformed cell is coerced below instead of failing the whole parse
+            table = pacsv.read_csv(csv_file, convert_options=pacsv.ConvertOptions(
+                include_columns=names,
+                column_types={col: pa.string() for col in names}))
+            df = table.to_pandas(self_destruct=True)
+        else:
+            df = pd.read_csv(csv_file, usecols=names, dtype=str, engine="c")
+        df.columns = df.columns.str.strip()
+        return df.apply(lambda col: pd.to_numeric(col.str.strip(), errors="coerce"))
+
     def validate_csv(self, csv_file):
         """ Validate the contents of the CSV file by loading it into a DataFrame"""
         print(f"Reading {csv_file} into a dataframe...")
-        df = pd.read_csv(csv_file)
-        df.columns = df.columns.str.strip()
         gyro_acc_col = "Gyro Corrected 0.a"
         gyro_x_col = "Gyro Corrected 0.x"
         gyro_y_col = "Gyro Corrected 0.y"
         gyro_z_col = "Gyro Corrected 0.z"
-        for col in [gyro_acc_col, gyro_x_col, gyro_y_col, gyro_z_col]:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
-        gyro_start_idx = df[df[gyro_acc_col] == 3].index.min()
-        if pd.notna(gyro_start_idx):
+        needed = [gyro_acc_col, gyro_x_col, gyro_y_col, gyro_z_col]
+        df = self.read_columns(csv_file, needed)
+        reached_3 = df[gyro_acc_col].to_numpy() == 3
+        gyro_start_idx = int(reached_3.argmax()) if reached_3.any() else None
+        if gyro_start_idx is not None:
             print(f"Gyro Accuracy reaches 3 at index {gyro_start_idx}. Converting data to dps...")
             conversion_factor = 180 / np.pi
-            df.loc[gyro_start_idx:, [gyro_x_col, gyro_y_col, gyro_z_col]] *= conversion_factor
-            avg_x_mdps = np.mean(df.loc[gyro_start_idx:, gyro_x_col]) * 1000
-            avg_y_mdps = np.mean(df.loc[gyro_start_idx:, gyro_y_col]) * 1000
-            avg_z_mdps = np.mean(df.loc[gyro_start_idx:, gyro_z_col]) * 1000
+            gyro_xyz_cols = [gyro_x_col, gyro_y_col, gyro_z_col]
+            gyro_xyz = df.loc[gyro_start_idx:, gyro_xyz_cols].to_numpy(dtype=np.float32, copy=True)
+            gyro_xyz *= np.float32(conversion_factor)
+            df.loc[gyro_start_idx:, gyro_xyz_cols] = gyro_xyz
+            avg_mdps = np.nanmean(gyro_xyz, axis=0, dtype=np.float64) * 1000
+            avg_x_mdps, avg_y_mdps, avg_z_mdps = avg_mdps
             print(f"Average Gyro Corrected 0.x: {avg_x_mdps:.2f} mdps")
             print(f"Average Gyro Corrected 0.y: {avg_y_mdps:.2f} mdps")
             print(f"Average Gyro Corrected 0.z: {avg_z_mdps:.2f} mdps")
-            if abs(avg_x_mdps) <= 50 and abs(avg_y_mdps) <= 50 and abs(avg_z_mdps) <= 50:
+            if np.all(np.abs(avg_mdps) <= 50):
                 print("PASS: Average x, y, z milidps are within 50 milidps.")
             else:
                 print("FAIL: Average x, y, z milidps are not within 50 milidps.")
         else:
             print("Gyro Accuracy never reaches 3. No conversion performed.")
         column_name = "Gyro Corrected 0.a"
-        df[column_name] = pd.to_numeric(df[column_name], errors="coerce")
         if column_name in df.columns:
             print(f"Generating HTML plot for {column_name}...")
             fig = go.Figure()
-            fig.add_trace(go.Scatter(
-            x=df.index, 
-            y=df[column_name],
+            fig.add_trace(go.Scattergl(
+            x=np.arange(len(df), dtype=np.int32),
+            y=df[column_name].to_numpy(dtype=np.float32),
             mode='lines',
             name=column_name,
             line=dict(color='blue')
@@ -156,8 +169,8 @@ class BLEFileHandler:
             yaxis_title="Gyro Corrected 0.a",
             template="plotly_white"
         )
-            html_file = "gyro_corrected_plot_2753.html"
-            fig.write_html(html_file)
+            html_file = os.path.join(self.output_dir, "gyro_corrected_plot_2753.html")
+            fig.write_html(html_file, include_plotlyjs='cdn', validate=False)
             print(f"Plot saved as {html_file}.")
         else:
             print(f"Column '{column_name}' not found in the CSV file.")
@@ -167,28 +180,34 @@ class BLEFileHandler:
         """
         Main function to connect to the BLE device, read the .bin file, and process it.
         """
-        client = BleakClient(self.address)
         file_name = "2753.bin"
         try:
-            # Connect to the BLE device
-            await client.connect()
-            if client.is_connected:
+            async with pool.acquire(self.address) as client:
                 print(f"Connected to {self.address[-5:]} ({self.address})")
+                self.write_len = await negotiate_mtu(client)
                 bin_file = await self.read_large_binary_file(client, file_name)
-                self.clean_bin_file(bin_file)
-                csv_file = self.convert_bin_to_csv(bin_file)
-                self.validate_csv(csv_file)
+                # Post-processing is blocking, keep it off the event loop
+                await asyncio.to_thread(self.clean_bin_file, bin_file)
+                csv_file = await asyncio.to_thread(self.convert_bin_to_csv, bin_file)
+                await asyncio.to_thread(self.validate_csv, csv_file)
         except BleakError as e:
             print(f"Error connecting to {self.address}: {e}")
-        finally:
-            if client.is_connected:
-                await client.disconnect()
-                print(f"Disconnected from {self.address[-5:]}.")
 
 if __name__ == "__main__":
-    BLE_MAC_ADDRESS = "C4:13:E5:CD:37:72"
-    handler = BLEFileHandler(BLE_MAC_ADDRESS)
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    BLE_MAC_ADDRESSES = ["C4:13:E5:CD:37:72"]
+    handlers = [BLEFileHandler(address) for address in BLE_MAC_ADDRESSES]
+
+    async def main():
+        try:
+            results = await asyncio.gather(*(handler.run() for handler in handlers), return_exceptions=True)
+        finally:
+            await pool.close()
+        for handler, result in zip(handlers, results):
+            if isinstance(result, Exception):
+                print(f"Processing failed for {handler.address}: {result}")
+
     try:
-        asyncio.run(handler.run())
+        asyncio.run(main())
     except asyncio.CancelledError:
         print("File transfer process was interrupted.")
@@ -1,57 +1,68 @@
 import asyncio 
-from bleak import BleakClient, BleakError
+import logging
+from bleak import BleakError
+from connection_pool import negotiate_mtu, parse_accuracy, pool
 import time
 
+logger = logging.getLogger(__name__)
+
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e" # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
+BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+
 SENSOR_NAMES = ["Orient_H_P_R:","Gravity_X_Y_Z:", "Linear_Acc_X_Y_Z:","ACC_CRCTD_X_Y_Z:"]
 DISABLED_SENSORS = {"Linear_Acc_X_Y_Z:", "Gravity_X_Y_Z:", "ACC_CRCTD_X_Y_Z:", "Orient_H_P_R:"}
+SENSOR_NAME_BYTES = [(sensor, sensor.encode()) for sensor in SENSOR_NAMES]
+
 
 class BLEConfigurator:
     def __init__(self, address):
         self.address = address
         self.response_log = [] 
         self.client = None
-        self.gyro_calibration_complete = False
-        self.accel_calibration_complete = False
+        self.write_len = BLE_GATT_WRITE_LEN
+        self.gyro_done = asyncio.Event()
+        self.accel_done = asyncio.Event()
         self.gyro_calibration_start_time = None
         self.gyro_calibration_end_time = None
         self.sensor_data_present = set()
     
     async def nus_data_rcv_handler(self, sender, data):
-        decoded_data = data.decode('utf-8').strip()
-        print(f"[Received]: {decoded_data}")
-        self.response_log.append(decoded_data)
-        for sensor in SENSOR_NAMES:
-            if sensor in decoded_data:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[Received]: %s", data.decode('utf-8', errors='ignore').strip())
+        self.response_log.append(bytes(data))
+        for sensor, sensor_bytes in SENSOR_NAME_BYTES:
+            if sensor_bytes in data:
                 self.sensor_data_present.add(sensor)
-        if "Gyro Accuracy" in decoded_data:
-            accuracy = int(decoded_data.split()[-1])
-            if accuracy == 1 and self.gyro_calibration_start_time is None:
-                self.gyro_calibration_start_time = time.time()
-            if accuracy == 3:
-                self.gyro_calibration_end_time = time.time()
-                self.gyro_calibration_complete = True
-                calibration_time = self.gyro_calibration_end_time - self.gyro_calibration_start_time
-                print(f"Gyroscope calibration complete. Time taken: {calibration_time:.2f} seconds.")
-        if "Accel Accuracy" in decoded_data:
-            accuracy = int(decoded_data.split()[-1])
-            if accuracy == 3:
-                print("Accelerometer calibration complete.")
-                self.accel_calibration_complete = True
+        # Only accuracy lines matter below, skip everything else without decoding it
+        if b"Accuracy" not in data:
+            return
+        accuracy = parse_accuracy(data, b"Gyro Accuracy")
+        if accuracy == 1 and self.gyro_calibration_start_time is None:
+            self.gyro_calibration_start_time = time.time()
+        if accuracy == 3:
+            self.gyro_calibration_end_time = time.time()
+            self.gyro_done.set()
+            calibration_time = self.gyro_calibration_end_time - self.gyro_calibration_start_time
+            print(f"Gyroscope calibration complete. Time taken: {calibration_time:.2f} seconds.")
+        if parse_accuracy(data, b"Accel Accuracy") == 3:
+            print("Accelerometer calibration complete.")
+            self.accel_done.set()
 
     async def send_command(self, command):
-        print(f"[Sending]: {command}")
-        await self.client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
+        logger.debug("[Sending]: %s", command)
+        payload = memoryview((command + '\n').encode())
+        for i in range(0, len(payload), self.write_len):
+            await self.client.write_gatt_char(NUS_RX_UUID, payload[i:i + self.write_len])
         await asyncio.sleep(0.5)
 
     async def run(self):
-        self.client = BleakClient(self.address)
         try:
-            await self.client.connect()
+            self.client = await pool.get(self.address)
             print("Connected to device.")
+            self.write_len = await negotiate_mtu(self.client)
             await self.client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
             await self.send_command("crt")
             await self.send_command("-f l")
@@ -59,11 +70,9 @@ class BLEConfigurator:
                 await self.send_command(cmd)
             print("Waiting 15 seconds for gyro calibration...")
             await asyncio.sleep(15)
-            while not self.gyro_calibration_complete:
-                await asyncio.sleep(1)
+            await self.gyro_done.wait()
             print("Perform accel calibration by keeping each side of device stable for 3-4sec...")
-            while not self.accel_calibration_complete:
-                await asyncio.sleep(1)
+            await self.accel_done.wait()
             await self.send_command("-a 1")
             if all(sensor in self.sensor_data_present for sensor in SENSOR_NAMES):
                 print("PASS: All expected sensors are streaming data.")
@@ -82,15 +91,24 @@ class BLEConfigurator:
         except BleakError as e:
             print(f"Error: {e}")
         finally:
-            if self.client.is_connected:
-                await self.client.stop_notify(NUS_TX_UUID)
-                await self.client.disconnect()
-                print("Disconnected.")
+            if self.client is not None:
+                try:
+                    await self.client.stop_notify(NUS_TX_UUID)
+                except Exception:
+                    pass
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
     BLE_MAC_ADDRESS = "C4:13:E5:CD:37:72"
     configurator = BLEConfigurator(BLE_MAC_ADDRESS)
+
+    async def main():
+        try:
+            await configurator.run()
+        finally:
+            await pool.close()
+
     try:
-        asyncio.run(configurator.run())
+        asyncio.run(main())
     except asyncio.CancelledError:
         print("Process interrupted.")
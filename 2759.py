@@ -1,7 +1,11 @@
 import asyncio  
-from bleak import BleakClient, BleakError
+import logging
+from bleak import BleakError
+from connection_pool import negotiate_mtu, parse_accuracy, pool
 import time
 
+logger = logging.getLogger(__name__)
+
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"
@@ -9,36 +13,42 @@ NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"
 BLE_GATT_WRITE_LEN = 20
 RECONNECT_ATTEMPTS = 5
 
+
 class BLEConfigurator:
     def __init__(self, address):
         self.address = address
         self.response_log = []
         self.client = None
-        self.gyro_calibration_complete = False
-        self.accel_calibration_complete = False
+        self.write_len = BLE_GATT_WRITE_LEN
+        self.gyro_done = asyncio.Event()
+        self.accel_done = asyncio.Event()
         self.accuracy_info_received = False
 
     async def nus_data_rcv_handler(self, sender, data):
-        decoded_data = data.decode('utf-8').strip()
-        print(f"[Received]: {decoded_data}")
-        self.response_log.append(decoded_data)
-        if "Gyro Accuracy" in decoded_data or "Accel Accuracy" in decoded_data:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[Received]: %s", data.decode('utf-8', errors='ignore').strip())
+        self.response_log.append(bytes(data))
+        if b"Accuracy" not in data:
+            return
+        if b"Gyro Accuracy" in data or b"Accel Accuracy" in data:
             self.accuracy_info_received = True
-        if "Gyro Accuracy" in decoded_data and int(decoded_data.split()[-1]) == 3:
-            self.gyro_calibration_complete = True
-        if "Accel Accuracy" in decoded_data and int(decoded_data.split()[-1]) == 3:
-            self.accel_calibration_complete = True
+        if parse_accuracy(data, b"Gyro Accuracy") == 3:
+            self.gyro_done.set()
+        if parse_accuracy(data, b"Accel Accuracy") == 3:
+            self.accel_done.set()
 
     async def send_command(self, command):
-        print(f"[Sending]: {command}")
-        await self.client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
+        logger.debug("[Sending]: %s", command)
+        payload = memoryview((command + '\n').encode())
+        for i in range(0, len(payload), self.write_len):
+            await self.client.write_gatt_char(NUS_RX_UUID, payload[i:i + self.write_len])
         await asyncio.sleep(0.5)
 
     async def connect_and_configure(self):
-        self.client = BleakClient(self.address)
         try:
-            await self.client.connect()
+            self.client = await pool.get(self.address)
             print("Connected to device.")
+            self.write_len = await negotiate_mtu(self.client)
             await self.client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
             await self.send_command("crt")
             await self.send_command("-f l") 
@@ -51,10 +61,12 @@ class BLEConfigurator:
 
     async def disconnect_device(self):
         try:
-            if self.client and self.client.is_connected:
-                await self.client.stop_notify(NUS_TX_UUID)
-                await self.client.disconnect()
-                print("Disconnected successfully.")
+            if self.client is not None:
+                try:
+                    await self.client.stop_notify(NUS_TX_UUID)
+                except Exception:
+                    pass
+            await pool.release(self.address)
         except Exception as e:
             print(f"Error during disconnection: {e}")
 
@@ -62,10 +74,7 @@ class BLEConfigurator:
         if not await self.connect_and_configure():
             return
         print("Gyroscope and accelerometer calibration started....")
-        while not self.gyro_calibration_complete:
-            await asyncio.sleep(1)
-        while not self.accel_calibration_complete:
-            await asyncio.sleep(1)
+        await asyncio.gather(self.gyro_done.wait(), self.accel_done.wait())
         await asyncio.sleep(5)
         print("Calibration complete. Disconnecting device...")
         await self.disconnect_device()
@@ -85,9 +94,17 @@ class BLEConfigurator:
                 print("FAIL: Accuracy info received unexpectedly.")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
     BLE_MAC_ADDRESS = "C4:13:E5:CD:37:72"
     configurator = BLEConfigurator(BLE_MAC_ADDRESS)
+
+    async def main():
+        try:
+            await configurator.run()
+        finally:
+            await pool.close()
+
     try:
-        asyncio.run(configurator.run())
+        asyncio.run(main())
     except asyncio.CancelledError:
         print("Process interrupted.")
\ No newline at end of file
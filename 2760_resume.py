@@ -1,12 +1,20 @@
 import asyncio 
-from bleak import BleakClient, BleakError
+import collections
+import logging
+from bleak import BleakError
+from connection_pool import pool
 import time
 
+logger = logging.getLogger(__name__)
+
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e" # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+ACK_TOKEN = b"Executing"  # Text the device prints when it starts running a command
+ACK_TIMEOUT = 0.5  # Max seconds to wait for the ack before sending the next command
+RESPONSE_LOG_LEN = 256  # Most recent notifications kept for post-mortem inspection
 
 class BLEConfigurator:
     """
@@ -15,8 +23,11 @@ class BLEConfigurator:
 
     def __init__(self, address):
         self.address = address
-        self.response_log = [] 
+        self.response_log = collections.deque(maxlen=RESPONSE_LOG_LEN)
+        self.ack = asyncio.Event()
         self.client = None
+        self.rx_char = None  # NUS characteristics resolved once on connect
+        self.tx_char = None
         self.gyro_calibration_complete = False
         self.accel_calibration_complete = False
         self.gyro_calibration_start_time = None
@@ -26,45 +37,77 @@ class BLEConfigurator:
         """
         Handle incoming notifications from the BLE device.
         """
-        decoded_data = data.decode('utf-8').strip()
-        print(f"[Received]: {decoded_data}")
-        self.response_log.append(decoded_data)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[Received from %s]: %s", self.address[-5:], data.decode('utf-8', errors='ignore').strip())
+        self.response_log.append(bytes(data))
+        if ACK_TOKEN in data:
+            self.ack.set()
+
+    async def wait_for_ack(self):
+        """Wait until the device acks the last command, or ACK_TIMEOUT for devices that stay silent."""
+        try:
+            await asyncio.wait_for(self.ack.wait(), timeout=ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
 
-    async def send_command(self, command):
-        """Send a single command to the BLE device."""
-        print(f"[Sending]: {command}")
-        await self.client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        await asyncio.sleep(0.5)
+    async def send_command(self, command, ack=True):
+        """Send a single command to the BLE device. Toggles sent with ack=False are not waited on."""
+        logger.debug("[Sending to %s]: %s", self.address[-5:], command)
+        if not ack:
+            await self.client.write_gatt_char(self.rx_char, (command + '\n').encode(), response=False)
+            return
+        self.ack.clear()
+        await self.client.write_gatt_char(self.rx_char, (command + '\n').encode())
+        await self.wait_for_ack()
 
     async def run(self):
         """Main function to connect, configure, calibrate, and disconnect."""
-        self.client = BleakClient(self.address)
+        connected = False  # Tracked locally so teardown needs no is_connected round trip
         try:
-            await self.client.connect()
-            print("Connected to device.")
-            await self.client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
+            self.client = await pool.get(self.address)
+            connected = True
+            self.rx_char = self.client.services.get_characteristic(NUS_RX_UUID)
+            self.tx_char = self.client.services.get_characteristic(NUS_TX_UUID)
+            print(f"Connected to {self.address[-5:]} ({self.address})")
+            await self.client.start_notify(self.tx_char, self.nus_data_rcv_handler)
             await self.send_command("crt")
             await self.send_command("-f l")
             await self.send_command("sets imux")
             await asyncio.sleep(3)
-            await self.send_command("-l 1 resume.bin")
+            await self.send_command("-l 1 resume.bin", ack=False)
             await self.send_command("actse 52 100")
             await self.send_command("actse 54 100")
             await asyncio.sleep(10)
+            # Wait for the ack so logging is closed before notify stops and the link drops
             await self.send_command("-l 0")
             print("Logging stopped. Disconnecting device...")
         except BleakError as e:
             print(f"Error: {e}")
         finally:
-            if self.client.is_connected:
-                await self.client.stop_notify(NUS_TX_UUID)
-                await self.client.disconnect()
-                print("Disconnected.")
+            if connected and self.client is not None:
+                try:
+                    await self.client.stop_notify(self.tx_char)
+                except BleakError as e:
+                    # The link may have dropped mid-session; keep the original error and finish cleanup
+                    print(f"Error stopping notifications: {e}")
 
 if __name__ == "__main__":
-    BLE_MAC_ADDRESS = "C4:13:E5:CD:37:72"
-    configurator = BLEConfigurator(BLE_MAC_ADDRESS)
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    # BLE device MAC addresses, sessions run concurrently
+    BLE_MAC_ADDRESSES = ["C4:13:E5:CD:37:72"]
+
+    configurators = [BLEConfigurator(address) for address in BLE_MAC_ADDRESSES]
+
+    async def main():
+        try:
+            results = await asyncio.gather(*(c.run() for c in configurators), return_exceptions=True)
+        finally:
+            await pool.close()
+        for configurator, result in zip(configurators, results):
+            if isinstance(result, Exception):
+                print(f"Error on {configurator.address}: {result}")
+
     try:
-        asyncio.run(configurator.run())
+        asyncio.run(main())
     except asyncio.CancelledError:
         print("Process interrupted.")
\ No newline at end of file
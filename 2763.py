@@ -1,63 +1,132 @@
 import asyncio 
-from bleak import BleakClient, BleakError
+import collections
+import logging
+from bleak import BleakError
+from connection_pool import drain_notifications, pool, stop_draining
+import re
 import time
 
+logger = logging.getLogger(__name__)
+
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e" # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
+BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+ACK_TOKEN = b"Executing"  # Text the device prints when it starts running a command
+ACK_TIMEOUT = 0.5  # Max seconds to wait for the ack before sending the next command
+RESPONSE_LOG_LEN = 256  # Most recent notifications kept for post-mortem inspection
+QUEUE_SIZE = 4096  # Notifications buffered between the notify callback and the drain task
+
 SENSOR_NAMES = ["GYRO_CRCTD_X_Y_Z","Gravity_X_Y_Z:", "Linear_Acc_X_Y_Z:","ACC_CRCTD_X_Y_Z:","GYR_PASSTHRO_X_Y_Z_A:","ACCEL_RAW_X_Y_Z_A:"]
+SENSOR_RE = re.compile("|".join(map(re.escape, SENSOR_NAMES)))  # Matches any expected sensor tag
 
 class BLEConfigurator:
     def __init__(self, address):
         self.address = address
-        self.response_log = [] 
+        self.response_log = collections.deque(maxlen=RESPONSE_LOG_LEN)
+        self.ack = asyncio.Event()
         self.client = None
+        self.rx_char = None  # NUS characteristics resolved once on connect
+        self.tx_char = None
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.dropped = 0
         self.sensor_data_present = set()
     
     async def nus_data_rcv_handler(self, sender, data):
-        decoded_data = data.decode('utf-8').strip()
-        print(f"[Received]: {decoded_data}")
-        self.response_log.append(decoded_data)
-        for sensor in SENSOR_NAMES:
-            if sensor in decoded_data:
-                self.sensor_data_present.add(sensor)
-
-    async def send_command(self, command):
-        print(f"[Sending]: {command}")
-        await self.client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        await asyncio.sleep(0.5)
+        if ACK_TOKEN in data:
+            self.ack.set()
+        try:
+            self.queue.put_nowait(bytes(data))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def process_notification(self, data):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[Received from %s]: %s", self.address[-5:], data.decode('utf-8', errors='ignore').strip())
+        self.response_log.append(data)
+        if len(self.sensor_data_present) < len(SENSOR_NAMES):
+            self.sensor_data_present.update(SENSOR_RE.findall(data.decode('utf-8', errors='ignore')))
+
+    async def wait_for_ack(self):
+        try:
+            await asyncio.wait_for(self.ack.wait(), timeout=ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    async def send_command(self, command, ack=True):
+        logger.debug("[Sending to %s]: %s", self.address[-5:], command)
+        if not ack:
+            await self.client.write_gatt_char(self.rx_char, (command + '\n').encode(), response=False)
+            return
+        self.ack.clear()
+        await self.client.write_gatt_char(self.rx_char, (command + '\n').encode())
+        await self.wait_for_ack()
+
+    async def send_commands(self, commands):
+        for command in commands:
+            logger.debug("[Sending to %s]: %s", self.address[-5:], command)
+        self.ack.clear()
+        payload = memoryview(("\n".join(commands) + "\n").encode())
+        for i in range(0, len(payload), BLE_GATT_WRITE_LEN):
+            await self.client.write_gatt_char(self.rx_char, payload[i:i + BLE_GATT_WRITE_LEN], response=False)
+        await self.wait_for_ack()
 
     async def run(self):
-        self.client = BleakClient(self.address)
+        connected = False  # Tracked locally so teardown needs no is_connected round trip
+        drain_task = None
         try:
-            await self.client.connect()
-            print("Connected to device.")
-            await self.client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
+            self.client = await pool.get(self.address)
+            connected = True
+            self.rx_char = self.client.services.get_characteristic(NUS_RX_UUID)
+            self.tx_char = self.client.services.get_characteristic(NUS_TX_UUID)
+            print(f"Connected to {self.address[-5:]} ({self.address})")
+            drain_task = asyncio.create_task(drain_notifications(self.queue, self.process_notification))
+            await self.client.start_notify(self.tx_char, self.nus_data_rcv_handler)
             await self.send_command("crt")
             await self.send_command("-f l")
-            for cmd in ["actse 52 50","actse 54 50", "actse 15 50", "actse 17 50", "actse 64 50", "actse 72 50"]:
-                await self.send_command(cmd)
-            await self.send_command("-a 1")
+            await self.send_commands(["actse 52 50","actse 54 50", "actse 15 50", "actse 17 50", "actse 64 50", "actse 72 50"])
+            await self.send_command("-a 1", ack=False)
             await asyncio.sleep(15)
             if all(sensor in self.sensor_data_present for sensor in SENSOR_NAMES):
                 print("PASS: All expected sensors are streaming data.")
             else:
                 print("FAIL: Some sensors are missing from the stream.")
+            # Wait for the ack so streaming is stopped before notify stops and the link drops
             await self.send_command("-a 0")
             print("Disconnecting device...")
         except BleakError as e:
             print(f"Error: {e}")
         finally:
-            if self.client.is_connected:
-                await self.client.stop_notify(NUS_TX_UUID)
-                await self.client.disconnect()
-                print("Disconnected.")
+            if connected and self.client is not None:
+                try:
+                    await self.client.stop_notify(self.tx_char)
+                except BleakError as e:
+                    # The link may have dropped mid-session; keep the original error and finish cleanup
+                    print(f"Error stopping notifications: {e}")
+            if drain_task is not None:
+                # Notifications are stopped, so anything still queued is processed rather than discarded
+                await stop_draining(drain_task, self.queue, self.process_notification)
+            if self.dropped:
+                print(f"Dropped {self.dropped} notifications from {self.address[-5:]}: queue full.")
 
 if __name__ == "__main__":
-    BLE_MAC_ADDRESS = "C4:13:E5:CD:37:72"
-    configurator = BLEConfigurator(BLE_MAC_ADDRESS)
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    # BLE device MAC addresses, sessions run concurrently
+    BLE_MAC_ADDRESSES = ["C4:13:E5:CD:37:72"]
+
+    configurators = [BLEConfigurator(address) for address in BLE_MAC_ADDRESSES]
+
+    async def main():
+        try:
+            results = await asyncio.gather(*(c.run() for c in configurators), return_exceptions=True)
+        finally:
+            await pool.close()
+        for configurator, result in zip(configurators, results):
+            if isinstance(result, Exception):
+                print(f"Error on {configurator.address}: {result}")
+
     try:
-        asyncio.run(configurator.run())
+        asyncio.run(main())
     except asyncio.CancelledError:
         print("Process interrupted.")
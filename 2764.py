@@ -1,12 +1,21 @@
 import asyncio 
-from bleak import BleakClient, BleakError
+import collections
+import logging
+from bleak import BleakError
+from connection_pool import drain_notifications, pool, stop_draining
 import time
 
+logger = logging.getLogger(__name__)
+
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e" # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+ACK_TOKEN = b"Executing"  # Text the device prints when it starts running a command
+ACK_TIMEOUT = 0.5  # Max seconds to wait for the ack before sending the next command
+RESPONSE_LOG_LEN = 256  # Most recent notifications kept for post-mortem inspection
+QUEUE_SIZE = 4096  # Notifications buffered between the notify callback and the drain task
 
 class BLEConfigurator:
     """
@@ -15,10 +24,15 @@ class BLEConfigurator:
 
     def __init__(self, address):
         self.address = address
-        self.response_log = [] 
+        self.response_log = collections.deque(maxlen=RESPONSE_LOG_LEN)
+        self.ack = asyncio.Event()
         self.client = None
-        self.gyro_calibration_complete = False
-        self.accel_calibration_complete = False
+        self.rx_char = None  # NUS characteristics resolved once on connect
+        self.tx_char = None
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.dropped = 0
+        self.gyro_done = asyncio.Event()
+        self.accel_done = asyncio.Event()
         self.gyro_calibration_start_time = None
         self.gyro_calibration_end_time = None
 
@@ -26,44 +40,76 @@ class BLEConfigurator:
         """
         Handle incoming notifications from the BLE device.
         """
-        decoded_data = data.decode('utf-8').strip()
-        print(f"[Received]: {decoded_data}")
-        self.response_log.append(decoded_data)
+        if ACK_TOKEN in data:
+            self.ack.set()
+        try:
+            self.queue.put_nowait(bytes(data))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def process_notification(self, data):
+        """
+        Log a queued notification and update the calibration state from it.
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[Received from %s]: %s", self.address[-5:], data.decode('utf-8', errors='ignore').strip())
+        self.response_log.append(data)
+        if b"Accuracy" not in data:
+            return
+        decoded_data = data.decode('utf-8', errors='ignore').strip()
         if "Gyro Accuracy" in decoded_data:
             accuracy = int(decoded_data.split()[-1])
             if accuracy == 1 and self.gyro_calibration_start_time is None:
                 self.gyro_calibration_start_time = time.time()
             if accuracy == 3:
                 self.gyro_calibration_end_time = time.time()
-                self.gyro_calibration_complete = True
-                calibration_time = self.gyro_calibration_end_time - self.gyro_calibration_start_time
-                print(f"Gyroscope calibration complete. Time taken: {calibration_time:.2f} seconds.")
-        if "Accel Accuracy" in decoded_data:
+                self.gyro_done.set()
+                if self.gyro_calibration_start_time is not None:
+                    calibration_time = self.gyro_calibration_end_time - self.gyro_calibration_start_time
+                    print(f"Gyroscope calibration complete. Time taken: {calibration_time:.2f} seconds.")
+                else:
+                    print("Gyroscope calibration complete.")
+        elif "Accel Accuracy" in decoded_data:
             accuracy = int(decoded_data.split()[-1])
             if accuracy == 3:
                 print("Accelerometer calibration complete.")
-                self.accel_calibration_complete = True
+                self.accel_done.set()
     
-    async def send_command(self, command):
-        """Send a single command to the BLE device."""
-        print(f"[Sending]: {command}")
-        await self.client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        await asyncio.sleep(0.5)
+    async def wait_for_ack(self):
+        """Wait until the device acks the last command, or ACK_TIMEOUT for devices that stay silent."""
+        try:
+            await asyncio.wait_for(self.ack.wait(), timeout=ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    async def send_command(self, command, ack=True):
+        """Send a single command to the BLE device. Toggles sent with ack=False are not waited on."""
+        logger.debug("[Sending to %s]: %s", self.address[-5:], command)
+        if not ack:
+            await self.client.write_gatt_char(self.rx_char, (command + '\n').encode(), response=False)
+            return
+        self.ack.clear()
+        await self.client.write_gatt_char(self.rx_char, (command + '\n').encode())
+        await self.wait_for_ack()
 
     async def run(self):
         """Main function to connect, configure, calibrate, and disconnect."""
-        self.client = BleakClient(self.address)
+        connected = False  # Tracked locally so teardown needs no is_connected round trip
+        drain_task = None
         try:
-            await self.client.connect()
-            print("Connected to device.")
-            await self.client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
+            self.client = await pool.get(self.address)
+            connected = True
+            self.rx_char = self.client.services.get_characteristic(NUS_RX_UUID)
+            self.tx_char = self.client.services.get_characteristic(NUS_TX_UUID)
+            print(f"Connected to {self.address[-5:]} ({self.address})")
+            drain_task = asyncio.create_task(drain_notifications(self.queue, self.process_notification))
+            await self.client.start_notify(self.tx_char, self.nus_data_rcv_handler)
             await self.send_command("crt")
             await self.send_command("-f l")
-            await self.send_command("-l 1 2764.bin")
+            await self.send_command("-l 1 2764.bin", ack=False)
             await self.send_command("actse 52 100")
             print("Perform Accel calibration. Keep each side of device stable for 3-4sec...")
-            while not self.accel_calibration_complete:
-                await asyncio.sleep(1)
+            await self.accel_done.wait()
             print("Enabling Linear accel and gravity vector sensor...")
             await self.send_command("actse 15 100")
             await asyncio.sleep(2)
@@ -72,20 +118,41 @@ class BLEConfigurator:
             await asyncio.sleep(15)
             print("Perform random hand movements for 20sec...")
             await asyncio.sleep(20)
+            # Wait for the ack so logging is closed before notify stops and the link drops
             await self.send_command("-l 0")
             print("Logging stopped. Disconnecting device...")
         except BleakError as e:
             print(f"Error: {e}")
         finally:
-            if self.client.is_connected:
-                await self.client.stop_notify(NUS_TX_UUID)
-                await self.client.disconnect()
-                print("Disconnected.")
+            if connected and self.client is not None:
+                try:
+                    await self.client.stop_notify(self.tx_char)
+                except BleakError as e:
+                    # The link may have dropped mid-session; keep the original error and finish cleanup
+                    print(f"Error stopping notifications: {e}")
+            if drain_task is not None:
+                # Notifications are stopped, so anything still queued is processed rather than discarded
+                await stop_draining(drain_task, self.queue, self.process_notification)
+            if self.dropped:
+                print(f"Dropped {self.dropped} notifications from {self.address[-5:]}: queue full.")
 
 if __name__ == "__main__":
-    BLE_MAC_ADDRESS = "FE:5F:42:38:8C:C0"
-    configurator = BLEConfigurator(BLE_MAC_ADDRESS)
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    # BLE device MAC addresses, sessions run concurrently
+    BLE_MAC_ADDRESSES = ["FE:5F:42:38:8C:C0"]
+
+    configurators = [BLEConfigurator(address) for address in BLE_MAC_ADDRESSES]
+
+    async def main():
+        try:
+            results = await asyncio.gather(*(c.run() for c in configurators), return_exceptions=True)
+        finally:
+            await pool.close()
+        for configurator, result in zip(configurators, results):
+            if isinstance(result, Exception):
+                print(f"Error on {configurator.address}: {result}")
+
     try:
-        asyncio.run(configurator.run())
+        asyncio.run(main())
     except asyncio.CancelledError:
         print("Process interrupted.")
\ No newline at end of file
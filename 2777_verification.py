@@ -5,6 +5,7 @@ import subprocess
 import pandas as pd
 import plotly.graph_objects as go
 from bleak import BleakClient, BleakError
+from connection_pool import receive_file
 
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"  # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
@@ -35,31 +36,9 @@ class BLEFileHandler:
         """
         Read a large binary file (up to max_size_mb) from the BLE device via notifications.
         """
-        max_size_bytes = max_size_mb * 1024 * 1024 
         local_path = os.path.join(self.output_dir, file_name)
-        file_data = bytearray()
-
-        def notification_handler(sender, data):
-            nonlocal file_data
-            decoded_data = data.decode(errors="ignore").strip()
-            if not decoded_data.startswith(("rd", "Executing rd")):
-                file_data.extend(data)
-                print(f"Received {len(data)} bytes of file data. Total: {len(file_data)} bytes.")
-            else:
-                print(f"Filtered out log message: {decoded_data}")
         print(f"Requesting file {file_name} from BLE device...")
-        await client.start_notify(NUS_TX_UUID, notification_handler)
-        await client.write_gatt_char(NUS_RX_UUID, f"rd {file_name}\n".encode())
-        timeout = 30 
-        for _ in range(timeout):
-            await asyncio.sleep(1)
-            if len(file_data) >= max_size_bytes:
-                print(f"File transfer limit of {max_size_mb} MB reached. Stopping...")
-                break
-        await client.stop_notify(NUS_TX_UUID)
-        with open(local_path, "wb") as f:
-            f.write(file_data)
-        print(f"File saved to {local_path} ({len(file_data)} bytes received)")
+        self.total_bytes = await receive_file(client, local_path, file_name, max_size_mb=max_size_mb)
         return local_path
 
     def clean_bin_file(self, bin_file):
@@ -1,16 +1,45 @@
 import asyncio
 import os
-import re
+import shutil
 import subprocess
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
-from bleak import BleakClient, BleakError
+from bleak import BleakError
+from connection_pool import pool, receive_file
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:  # Fall back to the pandas CSV reader
+    pa = pacsv = None
 
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"  # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+HEADER_SCAN_LEN = 64 * 1024  # Bytes searched for the header before falling back to the whole file
+
+# Header that marks the start of valid sensor data in the .bin file: "1.0", whitespace, then these fields in order
+HEADER_VERSION = b"1.0"
+HEADER_FIELDS = (b"1: Accelerometer (g):", b"2: Gyroscope (dps):", b"3: IMU Temperature (C):")
+
+
+def find_header(content):
+    """Return the offset of the data header in content, or -1 if it is not there."""
+    i = content.find(HEADER_FIELDS[0])
+    while i >= 0:
+        start = content.rfind(HEADER_VERSION, 0, i)
+        if start >= 0 and content[start + len(HEADER_VERSION):i].isspace():
+            pos = i
+            for field in HEADER_FIELDS[1:]:
+                pos = content.find(field, pos)
+                if pos < 0:
+                    return -1
+            return start
+        i = content.find(HEADER_FIELDS[0], i + 1)
+    return -1
 
 
 class BLEFileHandler:
@@ -18,48 +47,28 @@ class BLEFileHandler:
         self.address = address
         self.output_dir = "output"
         os.makedirs(self.output_dir, exist_ok=True)
+        self.rx_char = None  # NUS characteristics resolved once on connect
+        self.tx_char = None
+        self.total_bytes = 0
 
     async def send_command(self, client, command):
         """
         Send a command to the BLE device.
         """
         print(f"[Sending to {self.address[-5:]}]: {command}")
-        if len(command) <= BLE_GATT_WRITE_LEN:
-            await client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        else:
-            for i in range(0, len(command), BLE_GATT_WRITE_LEN):
-                await client.write_gatt_char(NUS_RX_UUID, command[i:i + BLE_GATT_WRITE_LEN].encode())
+        # Encode once and slice views of the same buffer for each write
+        buf = memoryview((command + '\n').encode())
+        for i in range(0, len(buf), BLE_GATT_WRITE_LEN):
+            await client.write_gatt_char(self.rx_char, buf[i:i + BLE_GATT_WRITE_LEN], response=False)
         await asyncio.sleep(0.5)
 
     async def read_large_binary_file(self, client, file_name, max_size_mb=10):
         """
         Read a large binary file (up to max_size_mb) from the BLE device via notifications.
         """
-        max_size_bytes = max_size_mb * 1024 * 1024 
         local_path = os.path.join(self.output_dir, file_name)
-        file_data = bytearray()
-
-        def notification_handler(sender, data):
-            nonlocal file_data
-            decoded_data = data.decode(errors="ignore").strip()
-            if not decoded_data.startswith(("rd", "Executing rd")):
-                file_data.extend(data)
-                print(f"Received {len(data)} bytes of file data. Total: {len(file_data)} bytes.")
-            else:
-                print(f"Filtered out log message: {decoded_data}")
         print(f"Requesting file {file_name} from BLE device...")
-        await client.start_notify(NUS_TX_UUID, notification_handler)
-        await client.write_gatt_char(NUS_RX_UUID, f"rd {file_name}\n".encode())
-        timeout = 30 
-        for _ in range(timeout):
-            await asyncio.sleep(1)
-            if len(file_data) >= max_size_bytes:
-                print(f"File transfer limit of {max_size_mb} MB reached. Stopping...")
-                break
-        await client.stop_notify(NUS_TX_UUID)
-        with open(local_path, "wb") as f:
-            f.write(file_data)
-        print(f"File saved to {local_path} ({len(file_data)} bytes received)")
+        self.total_bytes = await receive_file(client, local_path, file_name, max_size_mb=max_size_mb, rx_char=self.rx_char, tx_char=self.tx_char)
         return local_path
 
     def clean_bin_file(self, bin_file):
@@ -68,18 +77,18 @@ class BLEFileHandler:
         """
         print(f"Cleaning binary file: {bin_file}...")
         with open(bin_file, "rb") as f:
-            content = f.read()
-        decoded_content = content.decode(errors="ignore")
-        match = re.search(
-            r"1\.0\s+1: Accelerometer \(g\):.*?2: Gyroscope \(dps\):.*?3: IMU Temperature \(C\):", 
-            decoded_content,
-            re.DOTALL
-        )
-        if match:
-            valid_start = match.start()
-            valid_content = content[valid_start:]
-            with open(bin_file, "wb") as f:
-                f.write(valid_content)
+            # The header sits near the start, so only read the whole file if it is not found there
+            valid_start = find_header(f.read(HEADER_SCAN_LEN))
+            if valid_start < 0:
+                f.seek(0)
+                valid_start = find_header(f.read())
+            if valid_start >= 0:
+                tmp_file = bin_file + ".tmp"
+                f.seek(valid_start)
+                with open(tmp_file, "wb") as out:
+                    shutil.copyfileobj(f, out, 1 << 20)
+        if valid_start >= 0:
+            os.replace(tmp_file, bin_file)
             print("Binary file cleaned successfully.")
         else:
             raise ValueError("Valid header not found in the binary file. File might be corrupted.")
@@ -109,40 +118,61 @@ class BLEFileHandler:
             print(f"Error during conversion: {e}")
             raise
 
+    def read_columns(self, csv_file, columns):
+        """
+        Load only the given columns of the CSV as float64, matching header names after stripping.
+        Non-numeric cells become NaN.
+        """
+        header = pd.read_csv(csv_file, nrows=0).columns
+        names = [col for col in header if col.strip() in columns]
+        if pacsv is not None:
+            # Read as text so a malformed cell is coerced below instead of failing the whole parse
+            table = pacsv.read_csv(csv_file, convert_options=pacsv.ConvertOptions(
+                include_columns=names,
+                column_types={col: pa.string() for col in names}))
+            df = table.to_pandas(self_destruct=True)
+        else:
+            df = pd.read_csv(csv_file, usecols=names, dtype=str, engine="c")
+        df.columns = df.columns.str.strip()
+        return df.apply(lambda col: pd.to_numeric(col.str.strip(), errors="coerce"))
+
     def validate_csv(self, csv_file):
         """
         Validate the contents of the CSV file by loading it into a DataFrame and printing the first few rows.
         """
         print(f"Reading {csv_file} into a dataframe...")
-        df = pd.read_csv(csv_file)
-        df.columns = df.columns.str.strip()
         accel_columns = ['Accelerometer (g).x', 'Accelerometer (g).y', 'Accelerometer (g).z']
         accel_raw_columns = ['Accel Raw 0.x', 'Accel Raw 0.y', 'Accel Raw 0.z']
+        df = self.read_columns(csv_file, accel_columns + accel_raw_columns)
         converted_columns = [col.replace('Accelerometer (g)', 'Accel (m/s²)') for col in accel_columns]
-        for col, conv_col in zip(accel_columns, converted_columns):
-            df[conv_col] = pd.to_numeric(df[col], errors='coerce') * 9.80665
         avg_columns = [col.replace('Accelerometer (g)', 'Accel Avg') for col in accel_columns]
-        for conv_col, avg_col in zip(converted_columns, avg_columns):
-            df[avg_col] = df[conv_col].rolling(window=4, min_periods=4).mean()
-        for raw_col in accel_raw_columns:
-            df[raw_col] = pd.to_numeric(df[raw_col], errors='coerce')
         diff_columns = [col.replace('Accel Raw 0', 'Accel Diff') for col in accel_raw_columns]
-        for avg_col, raw_col, diff_col in zip(avg_columns, accel_raw_columns, diff_columns):
-            df[diff_col] = df[avg_col] - df[raw_col]
-        for diff_col in diff_columns:
-            df[diff_col] = df[diff_col].round(5)
-        df_after_20 = df[diff_columns].iloc[20:]
+        # Parsed as float64 so the diff checked to 1e-5 keeps the CSV's full precision
+        accel = df[accel_columns].to_numpy(dtype=np.float64)
+        accel *= 9.80665
+        raw = df[accel_raw_columns].to_numpy(dtype=np.float64)
+        # 4-sample trailing mean; a window containing NaN stays NaN, as with rolling(4).mean()
+        avg = np.full_like(accel, np.nan)
+        if len(accel) >= 4:
+            np.mean(np.lib.stride_tricks.sliding_window_view(accel, 4, axis=0), axis=-1, out=avg[3:])
+        diff = np.subtract(avg, raw)
+        np.round(diff, 5, out=diff)
         print("\nValues after 20 samples (Accel Diff columns):")
-        print(df_after_20.head(20))
-        df_after_20_normalized = df_after_20.applymap(lambda x: 0 if abs(x) < 1e-5 else x)
-        is_valid = df_after_20_normalized.isin([0, float('nan')]).all().all()
-        if is_valid:
+        print(pd.DataFrame(diff[20:40], index=df.index[20:40], columns=diff_columns))
+        diff_after_20 = diff[20:]
+        normalized = np.where(np.abs(diff_after_20) < 1e-5, 0.0, diff_after_20)
+        valid_rows = ((normalized == 0) | np.isnan(normalized)).all(axis=1)
+        if valid_rows.all():
             print("PASS")
         else:
             print("FAIL")
-            invalid_rows = df_after_20_normalized[~df_after_20_normalized.isin([0, float('nan')]).all(axis=1)]
+            invalid_rows = pd.DataFrame(normalized[~valid_rows], index=df.index[20:][~valid_rows], columns=diff_columns)
             print("Indexes and values of nonzero entries:")
             print(invalid_rows)
+        df[converted_columns] = accel
+        df[avg_columns] = avg
+        df[accel_raw_columns] = raw
+        df[diff_columns] = diff
         processed_df = df[accel_columns + converted_columns + avg_columns + accel_raw_columns + diff_columns]
         output_dir = os.path.dirname(csv_file)
         output_file = os.path.join(output_dir, "verified_" + os.path.basename(csv_file))
@@ -153,29 +183,33 @@ class BLEFileHandler:
         """
         Main function to connect to the BLE device, read the .bin file, and process it.
         """
-        client = BleakClient(self.address)
         file_name = "4676.bin"
         try:
-            await client.connect()
-            if client.is_connected:
+            async with pool.acquire(self.address) as client:
+                self.rx_char = client.services.get_characteristic(NUS_RX_UUID)
+                self.tx_char = client.services.get_characteristic(NUS_TX_UUID)
                 print(f"Connected to {self.address[-5:]} ({self.address})")
                 bin_file = await self.read_large_binary_file(client, file_name)
-                self.clean_bin_file(bin_file)
-                csv_file = self.convert_bin_to_csv(bin_file)
-                self.validate_csv(csv_file)
+                # Post-processing is blocking, keep it off the event loop
+                await asyncio.to_thread(self.clean_bin_file, bin_file)
+                csv_file = await asyncio.to_thread(self.convert_bin_to_csv, bin_file)
+                await asyncio.to_thread(self.validate_csv, csv_file)
         except BleakError as e:
             print(f"Error connecting to {self.address}: {e}")
-        finally:
-            if client.is_connected:
-                await client.disconnect()
-                print(f"Disconnected from {self.address[-5:]}.")
 
 if __name__ == "__main__":
     # BLE device MAC address
     BLE_MAC_ADDRESS = "FE:5F:42:38:8C:C0"
 
     handler = BLEFileHandler(BLE_MAC_ADDRESS)
+
+    async def main():
+        try:
+            await handler.run()
+        finally:
+            await pool.close()
+
     try:
-        asyncio.run(handler.run())
+        asyncio.run(main())
     except asyncio.CancelledError:
         print("File transfer process was interrupted.")
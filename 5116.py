@@ -1,11 +1,17 @@
 import asyncio
-from bleak import BleakClient, BleakError
+import collections
+import logging
+from bleak import BleakError
+from connection_pool import pool
+
+logger = logging.getLogger(__name__)
 
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"  # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"   # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"   # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+RESPONSE_LOG_LEN = 256  # Most recent notifications kept for post-mortem inspection
 
 
 class BLEConfigurator:
@@ -15,7 +21,11 @@ class BLEConfigurator:
 
     def __init__(self, address):
         self.address = address
-        self.response_log = []
+        self.response_log = collections.deque(maxlen=RESPONSE_LOG_LEN)
+        self.client = None
+        self.connected = False  # Tracked locally so teardown needs no is_connected round trip
+        self.rx_char = None  # NUS characteristics resolved once on connect
+        self.tx_char = None
         self.gyro_accuracy = 0
         self.accel_accuracy = 0
         self.commands = [
@@ -30,90 +40,98 @@ class BLEConfigurator:
         """
         Handle incoming notifications from the BLE device
         """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[Received from %s]: %s", self.address[-5:], data.decode('utf-8', errors='ignore').strip())
+        self.response_log.append(bytes(data))
+        if b"InvertQuaternion = 1" in data:
+            logger.info("Invert quaternion has been enabled successfully.")
+        if b"Accuracy" not in data:
+            return
         decoded_data = data.decode('utf-8').strip()
-        print(f"[Received from {sender}]: {decoded_data}")
-        self.response_log.append(decoded_data)
-        if "InvertQuaternion = 1" in decoded_data:
-            print("Invert quaternion has been enabled successfully.")
         if "Gyro Accuracy" in decoded_data:
             try:
                 self.gyro_accuracy = int(decoded_data.split()[-1])
             except ValueError:
                 pass
-        if "Accel Accuracy" in decoded_data:
+        elif "Accel Accuracy" in decoded_data:
             try:
                 self.accel_accuracy = int(decoded_data.split()[-1])
             except ValueError:
                 pass
         if self.gyro_accuracy == 1 and self.accel_accuracy == 1:
-            print("Gyro calibration started. Keep device stable for 15 seconds")
-            print("Accel calibration started. Place each side of the device flat for 3-4 seconds")
+            logger.info("Gyro calibration started. Keep device stable for 15 seconds")
+            logger.info("Accel calibration started. Place each side of the device flat for 3-4 seconds")
         if self.gyro_accuracy == 3 and self.accel_accuracy == 3:
-            print("Gyro and Accel calibration completed.")
+            logger.info("Gyro and Accel calibration completed.")
             await asyncio.sleep(5)
             await self.disconnect_device()
 
-    async def send_command(self, client, command):
-        """
-        Send a single command to the BLE device.
-        """
-        print(f"[Sending to {self.address[-5:]}]: {command}")
-        if len(command) <= BLE_GATT_WRITE_LEN:
-            await client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        else:
-            for i in range(0, len(command), BLE_GATT_WRITE_LEN):
-                await client.write_gatt_char(NUS_RX_UUID, command[i:i + BLE_GATT_WRITE_LEN].encode())
-        await asyncio.sleep(0.5)
-
     async def configure_device(self, client):
         """
-        Send configuration commands to the BLE device.
+        Send all configuration commands to the BLE device in one write-without-response burst.
         """
         for command in self.commands:
-            await self.send_command(client, command)
+            logger.debug("[Sending to %s]: %s", self.address[-5:], command)
+        payload = memoryview(('\n'.join(self.commands) + '\n').encode())
+        for i in range(0, len(payload), BLE_GATT_WRITE_LEN):
+            await client.write_gatt_char(self.rx_char, payload[i:i + BLE_GATT_WRITE_LEN], response=False)
 
     async def disconnect_device(self):
         """
         Disconnect from the BLE device, ensuring stop_notify is handled correctly.
         """
-        if self.client and self.client.is_connected:
+        if self.connected:
+            self.connected = False
             try:
-                await self.client.stop_notify(NUS_TX_UUID)
+                await self.client.stop_notify(self.tx_char)
             except Exception as e:
-                print(f"Error stopping notifications: {e}")
+                logger.error("Error stopping notifications: %s", e)
             try:
-                await self.client.disconnect()
-                print(f"Disconnected from {self.address[-5:]}.")
+                await pool.release(self.address)
             except Exception as e:
-                print(f"Error disconnecting: {e}")
+                logger.error("Error disconnecting: %s", e)
             self.client = None
 
     async def run(self):
         """
         Main function to connect to the BLE device, send commands, and stream data.
         """
-        self.client = BleakClient(self.address)
         try:
-            await self.client.connect()
-            if self.client.is_connected:
-                print(f"Connected to {self.address[-5:]} ({self.address})")
-                await self.client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
-                print("Sending configuration commands...")
-                await self.configure_device(self.client)
-                while True:
-                    await asyncio.sleep(1)
+            self.client = await pool.get(self.address)
+            self.connected = True
+            self.rx_char = self.client.services.get_characteristic(NUS_RX_UUID)
+            self.tx_char = self.client.services.get_characteristic(NUS_TX_UUID)
+            logger.info("Connected to %s (%s)", self.address[-5:], self.address)
+            await self.client.start_notify(self.tx_char, self.nus_data_rcv_handler)
+            logger.info("Sending configuration commands...")
+            await self.configure_device(self.client)
+            while True:
+                await asyncio.sleep(1)
         except BleakError as e:
-            print(f"Error connecting to {self.address}: {e}")
+            logger.error("Error connecting to %s: %s", self.address, e)
         except asyncio.CancelledError:
-            print("Configuration process was interrupted.")
+            logger.info("Configuration process was interrupted.")
         finally:
-            if self.client and self.client.is_connected:
-                await self.disconnect_device()
+            await self.disconnect_device()
 
 if __name__ == "__main__":
-    BLE_MAC_ADDRESS = "C4:13:E5:CD:37:72"
-    configurator = BLEConfigurator(BLE_MAC_ADDRESS)
+    # INFO carries the operator prompts; raise to DEBUG to see the BLE traffic
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    # BLE device MAC addresses, sessions run concurrently
+    BLE_MAC_ADDRESSES = ["C4:13:E5:CD:37:72"]
+
+    configurators = [BLEConfigurator(address) for address in BLE_MAC_ADDRESSES]
+
+    async def main():
+        try:
+            results = await asyncio.gather(*(c.run() for c in configurators), return_exceptions=True)
+        finally:
+            await pool.close()
+        for configurator, result in zip(configurators, results):
+            if isinstance(result, Exception):
+                logger.error("Error on %s: %s", configurator.address, result)
+
     try:
-        asyncio.run(configurator.run())
+        asyncio.run(main())
     except asyncio.CancelledError:
-        print("Configuration process was interrupted.")
+        logger.info("Configuration process was interrupted.")
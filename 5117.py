@@ -1,12 +1,22 @@
 import asyncio
+import logging
 from bleak import BleakClient, BleakError
+from connection_pool import drain_notifications, negotiate_mtu, pack_commands, parse_accuracy, request_fast_connection, stop_draining
 import time
 
+logger = logging.getLogger(__name__)
+
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"  # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"   # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"   # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+ACK_TOKEN = b"Executing"  # Text the device prints when it starts running a command
+ACK_TIMEOUT = 0.5  # Max seconds to wait for the ack before sending the next command
+QUEUE_SIZE = 4096  # Notifications buffered between the notify callback and the drain task
+DISCONNECT_DELAY = 5  # Seconds to keep streaming after calibration completes before disconnecting
+GYRO_PREFIX = b"Gyro Accuracy"  # Notification carrying the gyro calibration accuracy (0-3)
+ACCEL_PREFIX = b"Accel Accuracy"  # Notification carrying the accel calibration accuracy (0-3)
 
 
 class BLEConfigurator:
@@ -16,73 +26,99 @@ class BLEConfigurator:
 
     def __init__(self, address):
         self.address = address
-        self.response_log = []
+        self.write_len = BLE_GATT_WRITE_LEN  # Raised by negotiate_mtu once connected
+        self.rx_char = None  # NUS characteristics resolved once on connect
+        self.tx_char = None
+        self.write_response = True  # Cleared when RX accepts write-without-response
+        self.conn_params = None  # Preferred connection parameters request, when the OS supports it
+        self.ack = asyncio.Event()
+        self.acks_pending = 0  # Acks still owed for the commands in the last write
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.dropped = 0
         self.gyro_accuracy = 0
         self.accel_accuracy = 0
+        self.calibrated = asyncio.Event()
+        self.disconnected = asyncio.Event()
         self.commands = [
-            "crt",                  # Command to trigger crt
-            "-f l",                # Enable ImuX
-            "imux iq 0",           # Disable IMU Invert Quaternion
-            "-l 1 teste.bin",      # Create log file
-            "actse 9 100"         # Activate GRV sensor
+            b"crt\n",               # Command to trigger crt
+            b"-f l\n",             # Enable ImuX
+            b"imux iq 0\n",        # Disable IMU Invert Quaternion
+            b"-l 1 teste.bin\n",   # Create log file
+            b"actse 9 100\n"      # Activate GRV sensor
         ]
 
-    async def nus_data_rcv_handler(self, sender, data):
+    def nus_data_rcv_handler(self, sender, data):
+        """
+        Count acks and hand the notification to the drain task so Bleak is never held up.
+        """
+        if ACK_TOKEN in data:
+            # A packed write runs several commands; wait for one ack per line
+            self.acks_pending -= data.count(ACK_TOKEN)
+            if self.acks_pending <= 0:
+                self.ack.set()
+        try:
+            self.queue.put_nowait(bytes(data))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def process_notification(self, data):
         """
-        Handle incoming notifications from the BLE device
+        Handle a notification from the BLE device
         """
-        decoded_data = data.decode('utf-8').strip()
-        print(f"[Received from {sender}]: {decoded_data}")
-        self.response_log.append(decoded_data)
+        raw = data.rstrip()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[Received from %s]: %s", self.address[-5:], data.decode('utf-8', errors='ignore').strip())
 
         # Check if IMU FusionX confirms InvertQuaternion is set to 0
-        if "InvertQuaternion = 0" in decoded_data:
+        if b"InvertQuaternion = 0" in raw:
             print("Invert quaternion has been disabled successfully.")
 
-        # Parse gyro and accelerometer accuracy values
-        if "Gyro Accuracy" in decoded_data:
-            try:
-                self.gyro_accuracy = int(decoded_data.split()[-1])
-            except ValueError:
-                pass  # Ignore parsing errors
+        # Parse gyro and accelerometer accuracy values straight from the raw bytes
+        accuracy = parse_accuracy(raw, GYRO_PREFIX)
+        if accuracy is not None:
+            self.gyro_accuracy = accuracy
 
-        if "Accel Accuracy" in decoded_data:
-            try:
-                self.accel_accuracy = int(decoded_data.split()[-1])
-            except ValueError:
-                pass  # Ignore parsing errors
+        accuracy = parse_accuracy(raw, ACCEL_PREFIX)
+        if accuracy is not None:
+            self.accel_accuracy = accuracy
 
         # Check calibration progress
         if self.gyro_accuracy == 1 and self.accel_accuracy == 1:
             print("Gyro calibration started. Keep device stable for 15 seconds")
             print("Accel calibration started. Place each side of the device flat for 3-4 seconds")
 
-        if self.gyro_accuracy == 3 and self.accel_accuracy == 3:
+        if self.gyro_accuracy == 3 and self.accel_accuracy == 3 and not self.calibrated.is_set():
             print("Gyro and Accel calibration completed.")
-            # Wait for 5 seconds before disconnecting
-            await asyncio.sleep(5)
-            await self.disconnect_device()
+            self.calibrated.set()
 
-    async def send_command(self, client, command):
+    async def wait_for_ack(self):
         """
-        Send a single command to the BLE device.
+        Wait until the device acks the last command, or ACK_TIMEOUT for devices that stay silent.
         """
-        print(f"[Sending to {self.address[-5:]}]: {command}")
-        if len(command) <= BLE_GATT_WRITE_LEN:
-            await client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        else:
-            for i in range(0, len(command), BLE_GATT_WRITE_LEN):
-                await client.write_gatt_char(NUS_RX_UUID, command[i:i + BLE_GATT_WRITE_LEN].encode())
+        try:
+            await asyncio.wait_for(self.ack.wait(), timeout=ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
 
-        # Waiting briefly to allow the BLE device to process and respond
-        await asyncio.sleep(0.5)
+    async def send_command(self, client, command):
+        """
+        Send one or more newline-terminated bytes commands to the BLE device.
+        """
+        logger.debug("[Sending to %s]: %s", self.address[-5:], command.decode().rstrip())
+        # Commands arrive newline-terminated as bytes; slice views of the same buffer for each write
+        payload = memoryview(command)
+        self.acks_pending = command.count(b"\n")
+        self.ack.clear()
+        for i in range(0, len(payload), self.write_len):
+            await client.write_gatt_char(self.rx_char, payload[i:i + self.write_len], response=self.write_response)
+        await self.wait_for_ack()
 
     async def configure_device(self, client):
         """
-        Send configuration commands to the BLE device.
+        Send configuration commands to the BLE device, packing as many as fit into each GATT write.
         """
-        for command in self.commands:
-            await self.send_command(client, command)
+        for payload in pack_commands(self.commands, self.write_len):
+            await self.send_command(client, payload)
 
     async def disconnect_device(self):
         """
@@ -90,7 +126,7 @@ class BLEConfigurator:
         """
         if self.client and self.client.is_connected:
             try:
-                await self.client.stop_notify(NUS_TX_UUID)
+                await self.client.stop_notify(self.tx_char)
             except Exception as e:
                 print(f"Error stopping notifications: {e}")
             try:
@@ -100,26 +136,47 @@ class BLEConfigurator:
                 print(f"Error disconnecting: {e}")
             self.client = None  # Clear the client reference
 
+    def on_disconnect(self, client):
+        """
+        Called by Bleak when the link drops, whether we closed it or the device did.
+        """
+        self.disconnected.set()
+
     async def run(self):
         """
         Main function to connect to the BLE device, send commands, and stream data.
         """
-        self.client = BleakClient(self.address)
+        self.client = BleakClient(self.address, disconnected_callback=self.on_disconnect)
+        drain_task = None
         try:
             await self.client.connect()
             if self.client.is_connected:
                 print(f"Connected to {self.address[-5:]} ({self.address})")
+                self.conn_params = request_fast_connection(self.client)
+                self.write_len = await negotiate_mtu(self.client)
+                self.rx_char = self.client.services.get_characteristic(NUS_RX_UUID)
+                self.tx_char = self.client.services.get_characteristic(NUS_TX_UUID)
+                self.write_response = "write-without-response" not in self.rx_char.properties
 
                 # Start receiving notifications
-                await self.client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
+                drain_task = asyncio.create_task(drain_notifications(self.queue, self.process_notification))
+                await self.client.start_notify(self.tx_char, self.nus_data_rcv_handler)
 
                 # Sending configuration commands
                 print("Sending configuration commands...")
                 await self.configure_device(self.client)
 
-                # Keep receiving notifications
-                while True:
-                    await asyncio.sleep(1)
+                # Keep receiving notifications until calibration completes or the link drops
+                waiters = [asyncio.create_task(self.calibrated.wait()), asyncio.create_task(self.disconnected.wait())]
+                await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                for waiter in waiters:
+                    waiter.cancel()
+
+                # Keep streaming for DISCONNECT_DELAY seconds before disconnecting
+                try:
+                    await asyncio.wait_for(self.disconnected.wait(), timeout=DISCONNECT_DELAY)
+                except asyncio.TimeoutError:
+                    pass
 
         except BleakError as e:
             print(f"Error connecting to {self.address}: {e}")
@@ -128,9 +185,14 @@ class BLEConfigurator:
         finally:
             if self.client and self.client.is_connected:
                 await self.disconnect_device()
+            if drain_task is not None:
+                await stop_draining(drain_task, self.queue, self.process_notification)
+            if self.dropped:
+                print(f"Dropped {self.dropped} notifications from {self.address[-5:]}: queue full.")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
     # BLE device MAC address
     BLE_MAC_ADDRESS = "F3:D9:31:80:1B:0B"
 
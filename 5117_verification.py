@@ -1,89 +1,63 @@
 import asyncio 
+import logging
 import os
 import re
-import subprocess
+import numpy as np
 import pandas as pd
 from bleak import BleakClient, BleakError
+from connection_pool import negotiate_mtu, receive_file
+
+logger = logging.getLogger(__name__)
 
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"  # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+HEADER_START_RE = re.compile(rb"1\.0\s+1: Accelerometer \(g\):")  # Start of the header that begins the valid data
+
+
+def find_header_start(buf):
+    """
+    Return the offset of the "1.0" that starts the data header in buf, or -1 if it is not there yet.
+    """
+    match = HEADER_START_RE.search(buf)
+    return match.start() if match else -1
 
 
 class BLEFileHandler:
     def __init__(self, address):
         self.address = address
+        self.write_len = BLE_GATT_WRITE_LEN  # Raised by negotiate_mtu once connected
+        self.rx_char = None  # NUS characteristics resolved once on connect
+        self.tx_char = None
+        self.write_response = True  # Cleared when RX accepts write-without-response
         self.output_dir = "output"
         os.makedirs(self.output_dir, exist_ok=True)
+        self.total_bytes = 0
 
     async def send_command(self, client, command):
         """
-        Send a command to the BLE device.
+        Send a newline-terminated bytes command to the BLE device.
         """
-        print(f"[Sending to {self.address[-5:]}]: {command}")
-        if len(command) <= BLE_GATT_WRITE_LEN:
-            await client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        else:
-            for i in range(0, len(command), BLE_GATT_WRITE_LEN):
-                await client.write_gatt_char(NUS_RX_UUID, command[i:i + BLE_GATT_WRITE_LEN].encode())
+        logger.debug("[Sending to %s]: %s", self.address[-5:], command.decode().rstrip())
+        # Commands arrive newline-terminated as bytes; slice views of the same buffer for each write
+        payload = memoryview(command)
+        for i in range(0, len(payload), self.write_len):
+            await client.write_gatt_char(self.rx_char, payload[i:i + self.write_len], response=self.write_response)
         await asyncio.sleep(0.5)
 
     async def read_large_binary_file(self, client, file_name, max_size_mb=10):
         """
         Read a large binary file (up to max_size_mb) from the BLE device via notifications.
         """
-        max_size_bytes = max_size_mb * 1024 * 1024
         local_path = os.path.join(self.output_dir, file_name)
-        file_data = bytearray()
-
-        def notification_handler(sender, data):
-            nonlocal file_data
-            decoded_data = data.decode(errors="ignore").strip()
-            if not decoded_data.startswith(("rd", "Executing rd")):
-                file_data.extend(data)
-                print(f"Received {len(data)} bytes of file data. Total: {len(file_data)} bytes.")
-            else:
-                print(f"Filtered out log message: {decoded_data}")
         print(f"Requesting file {file_name} from BLE device...")
-        await client.start_notify(NUS_TX_UUID, notification_handler)
-        await client.write_gatt_char(NUS_RX_UUID, f"rd {file_name}\n".encode())
-        timeout = 30
-        for _ in range(timeout):
-            await asyncio.sleep(1)
-            if len(file_data) >= max_size_bytes:
-                print(f"File transfer limit of {max_size_mb} MB reached. Stopping...")
-                break
-        await client.stop_notify(NUS_TX_UUID)
-        with open(local_path, "wb") as f:
-            f.write(file_data)
-        print(f"File saved to {local_path} ({len(file_data)} bytes received)")
+        self.total_bytes = await receive_file(client, local_path, file_name, max_size_mb=max_size_mb, rx_char=self.rx_char, tx_char=self.tx_char, response=self.write_response,
+            find_header=find_header_start)
         return local_path
 
-    def clean_bin_file(self, bin_file):
-        """
-        Cleans the .bin file by removing all content before the valid data header.
-        """
-        print(f"Cleaning binary file: {bin_file}...")
-        with open(bin_file, "rb") as f:
-            content = f.read()
-        decoded_content = content.decode(errors="ignore")
-        match = re.search(
-            r"1\.0\s+1: Accelerometer \(g\):.*?2: Gyroscope \(dps\):.*?3: IMU Temperature \(C\):", 
-            decoded_content,
-            re.DOTALL
-        )
-        if match:
-            valid_start = match.start()
-            valid_content = content[valid_start:]
-            with open(bin_file, "wb") as f:
-                f.write(valid_content)
-            print("Binary file cleaned successfully.")
-        else:
-            raise ValueError("Valid header not found in the binary file. File might be corrupted.")
-
-    def convert_bin_to_csv(self, bin_file):
+    async def convert_bin_to_csv(self, bin_file):
         """
         Convert the binary file to CSV using udf2csv.exe.
         """
@@ -93,14 +67,15 @@ class BLEFileHandler:
             raise FileNotFoundError(f"udf2csv.exe not found in {os.getcwd()}")
         print(f"Converting {bin_file} to CSV using {exe_path}...")
         try:
-            # Use subprocess to run udf2csv.exe
-            result = subprocess.run(
-                [exe_path, bin_file],
-                capture_output=True,
-                text=True
+            # Run udf2csv.exe without blocking the event loop; only stderr is needed, and only on failure
+            proc = await asyncio.create_subprocess_exec(
+                exe_path, bin_file,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
             )
-            if result.returncode != 0:
-                print(f"Error during conversion: {result.stderr}")
+            _, err = await proc.communicate()
+            if proc.returncode != 0:
+                print(f"Error during conversion: {err.decode(errors='ignore')}")
                 raise RuntimeError("Failed to convert .bin to .csv")
             print(f"CSV file created: {csv_file}")
             return csv_file
@@ -113,11 +88,16 @@ class BLEFileHandler:
         Validate the contents of the CSV file by loading it into a DataFrame and printing the first few rows.
         """
         print(f"Reading {csv_file} into a dataframe...")
-        df = pd.read_csv(csv_file)
-        df.columns = df.columns.str.strip()
         column_name = "Game Rotation vector 0.w"
-        df[column_name] = pd.to_numeric(df[column_name], errors="coerce")
-        if (df[column_name] < 0).any():
+        try:
+            df = pd.read_csv(csv_file, usecols=lambda c: c.strip() == column_name,
+                             dtype=np.float32, engine="c")
+        except ValueError:
+            # Non-numeric cells in the column; re-read it as text and drop what does not parse
+            df = pd.read_csv(csv_file, usecols=lambda c: c.strip() == column_name, engine="c")
+            df[df.columns[0]] = pd.to_numeric(df[df.columns[0]], errors="coerce")
+        df.columns = df.columns.str.strip()
+        if np.any(df[column_name].to_numpy() < 0):
             print(df[df[column_name] < 0][column_name].head())
             print("Negative real parts found in Game Rotation vector 0.w.") 
             print("PASS.")
@@ -137,9 +117,12 @@ class BLEFileHandler:
             await client.connect()
             if client.is_connected:
                 print(f"Connected to {self.address[-5:]} ({self.address})")
+                self.write_len = await negotiate_mtu(client)
+                self.rx_char = client.services.get_characteristic(NUS_RX_UUID)
+                self.tx_char = client.services.get_characteristic(NUS_TX_UUID)
+                self.write_response = "write-without-response" not in self.rx_char.properties
                 bin_file = await self.read_large_binary_file(client, file_name)
-                self.clean_bin_file(bin_file)
-                csv_file = self.convert_bin_to_csv(bin_file)
+                csv_file = await self.convert_bin_to_csv(bin_file)
                 self.validate_csv(csv_file)
         except BleakError as e:
             print(f"Error connecting to {self.address}: {e}")
@@ -154,6 +137,7 @@ class BLEFileHandler:
                     print("Disconnection timed out.")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
     # BLE device MAC address
     BLE_MAC_ADDRESS = "F3:D9:31:80:1B:0B"
 
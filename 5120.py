@@ -1,12 +1,23 @@
 import asyncio
+import logging
 from bleak import BleakClient, BleakError
-from tkinter import Tk, Label
+from connection_pool import drain_notifications, negotiate_mtu, pack_commands, parse_accuracy, request_fast_connection, stop_draining
+from tkinter import Tk, Label, TclError
+
+logger = logging.getLogger(__name__)
 
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"  # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"   # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"   # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+ACK_TOKEN = b"Executing"  # Text the device prints when it starts running a command
+ACK_TIMEOUT = 0.5  # Max seconds to wait for the ack before sending the next command
+QUEUE_SIZE = 4096  # Notifications buffered between the notify callback and the drain task
+ACCEL_PREFIX = b"Accel Accuracy"  # Notification carrying the accel calibration accuracy (0-3)
+RESPONSE_TIMEOUT = 2.0  # Max seconds to wait for a range change to be confirmed
+POPUP_REFRESH = 0.05  # Seconds between Tk event pumps while a popup is open
+
 
 class BLEConfigurator:
     """
@@ -15,16 +26,26 @@ class BLEConfigurator:
 
     def __init__(self, address):
         self.address = address
-        self.response_log = []
+        self.write_len = BLE_GATT_WRITE_LEN  # Raised by negotiate_mtu once connected
+        self.rx_char = None  # NUS characteristics resolved once on connect
+        self.tx_char = None
+        self.write_response = True  # Cleared when RX accepts write-without-response
+        self.conn_params = None  # Preferred connection parameters request, when the OS supports it
+        self.ack = asyncio.Event()
+        self.acks_pending = 0  # Acks still owed for the commands in the last write
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.dropped = 0
+        self.awaited = {}  # Response token (bytes) -> Event set when the device sends it
         self.commands = [
-            "crt",                  
-            "-f l",                 
-            "-l 1 lal.bin",       
-            "actse 52 100"          
+            b"crt\n",                  
+            b"-f l\n",                 
+            b"-l 1 lal.bin\n",       
+            b"actse 52 100\n"          
         ]
         self.accel_ranges = [2, 4, 8]  # Accelerometer ranges to configure
-        self.accel_accuracy = 0
+        self.accel_done = asyncio.Event()
         self.popup = None
+        self.popup_task = None
 
     def show_popup(self, message):
         """
@@ -33,15 +54,19 @@ class BLEConfigurator:
         self.popup = Tk()
         self.popup.title("Calibration Instructions")
         Label(self.popup, text=message, padx=20, pady=20).pack()
-        self.popup.after(100, self._poll_popup)
-        self.popup.update()
+        self.popup_task = asyncio.create_task(self.pump_popup())
 
-    def _poll_popup(self):
+    async def pump_popup(self):
         """
-        Poll the popup to keep it responsive.
+        Keep the popup responsive by processing Tk events from the asyncio loop.
         """
-        if self.popup is not None:
-            self.popup.update()
+        while self.popup is not None:
+            try:
+                self.popup.update()
+            except TclError:
+                self.popup = None  # Window was closed by the user
+                break
+            await asyncio.sleep(POPUP_REFRESH)
 
     def close_popup(self):
         """
@@ -51,34 +76,56 @@ class BLEConfigurator:
             self.popup.destroy()
             self.popup = None
 
-    async def nus_data_rcv_handler(self, sender, data):
+    def nus_data_rcv_handler(self, sender, data):
         """
-        Handle incoming notifications from the BLE device.
+        Count acks and hand the notification to the drain task so Bleak is never held up.
         """
-        decoded_data = data.decode('utf-8').strip()
-        print(f"[Received from {sender}]: {decoded_data}")
-        self.response_log.append(decoded_data)
-        if "Accel Accuracy" in decoded_data:
-            try:
-                accuracy = int(decoded_data.split()[-1])
-                if accuracy == 3:
-                    print("Accelerometer calibration completed.")
-                    self.accel_accuracy = accuracy
-                    self.close_popup()
-            except ValueError:
-                pass
+        if ACK_TOKEN in data:
+            # A packed write runs several commands; wait for one ack per line
+            self.acks_pending -= data.count(ACK_TOKEN)
+            if self.acks_pending <= 0:
+                self.ack.set()
+        try:
+            self.queue.put_nowait(bytes(data))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def process_notification(self, data):
+        """
+        Handle a notification from the BLE device.
+        """
+        raw = data.rstrip()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[Received from %s]: %s", self.address[-5:], data.decode('utf-8', errors='ignore').strip())
+        for token, event in self.awaited.items():
+            if not event.is_set() and token in raw:
+                event.set()
+        if parse_accuracy(raw, ACCEL_PREFIX) == 3:
+            print("Accelerometer calibration completed.")
+            self.accel_done.set()
+            self.close_popup()
+
+    async def wait_for_ack(self):
+        """
+        Wait until the device acks the last command, or ACK_TIMEOUT for devices that stay silent.
+        """
+        try:
+            await asyncio.wait_for(self.ack.wait(), timeout=ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
 
     async def send_command(self, client, command):
         """
-        Send a single command to the BLE device.
+        Send one or more newline-terminated bytes commands to the BLE device.
         """
-        print(f"[Sending to {self.address[-5:]}]: {command}")
-        if len(command) <= BLE_GATT_WRITE_LEN:
-            await client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        else:
-            for i in range(0, len(command), BLE_GATT_WRITE_LEN):
-                await client.write_gatt_char(NUS_RX_UUID, command[i:i + BLE_GATT_WRITE_LEN].encode())
-        await asyncio.sleep(0.5)
+        logger.debug("[Sending to %s]: %s", self.address[-5:], command.decode().rstrip())
+        # Commands arrive newline-terminated as bytes; slice views of the same buffer for each write
+        payload = memoryview(command)
+        self.acks_pending = command.count(b"\n")
+        self.ack.clear()
+        for i in range(0, len(payload), self.write_len):
+            await client.write_gatt_char(self.rx_char, payload[i:i + self.write_len], response=self.write_response)
+        await self.wait_for_ack()
 
     async def wait_for_calibration(self):
         """
@@ -86,24 +133,34 @@ class BLEConfigurator:
         """
         print("Waiting for accelerometer calibration to complete...")
         self.show_popup("Place each axis of the device flat on the table for 3-4 seconds to complete calibration.")
-        while self.accel_accuracy < 3:
-            await asyncio.sleep(1)
+        await self.accel_done.wait()
         print("Calibration completed!")
 
+    async def await_response(self, token, timeout):
+        """
+        Wait for a registered response token to arrive. Returns False if it does not within timeout.
+        """
+        try:
+            await asyncio.wait_for(self.awaited[token].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
     async def configure_device(self, client):
         """
-        Send configuration commands to the BLE device.
+        Send configuration commands to the BLE device, packing as many as fit into each GATT write.
         """
-        for command in self.commands:
-            await self.send_command(client, command)
+        for payload in pack_commands(self.commands, self.write_len):
+            await self.send_command(client, payload)
         print("Basic configuration commands sent.")
         await self.wait_for_calibration()
         for range_value in self.accel_ranges:
-            command = f"aconf {range_value} 2 2"
-            await self.send_command(client, command)
-            await asyncio.sleep(2)
+            command = f"aconf {range_value} 2 2\n".encode()
             expected_response = f"Accel Range set to {range_value}G"
-            if any(expected_response in log for log in self.response_log):
+            token = expected_response.encode()
+            self.awaited[token] = asyncio.Event()
+            await self.send_command(client, command)
+            if await self.await_response(token, RESPONSE_TIMEOUT):
                 print(f"Response matched: {expected_response}")
             else:
                 print(f"Expected response not received: {expected_response}")
@@ -115,23 +172,35 @@ class BLEConfigurator:
         Main function to connect to the BLE device, send commands, and verify responses.
         """
         client = BleakClient(self.address)
+        drain_task = None
         try:
             await client.connect()
             if client.is_connected:
                 print(f"Connected to {self.address[-5:]} ({self.address})")
-                await client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
+                self.conn_params = request_fast_connection(client)
+                self.write_len = await negotiate_mtu(client)
+                self.rx_char = client.services.get_characteristic(NUS_RX_UUID)
+                self.tx_char = client.services.get_characteristic(NUS_TX_UUID)
+                self.write_response = "write-without-response" not in self.rx_char.properties
+                drain_task = asyncio.create_task(drain_notifications(self.queue, self.process_notification))
+                await client.start_notify(self.tx_char, self.nus_data_rcv_handler)
                 print("Sending configuration commands...")
                 await self.configure_device(client)
         except BleakError as e:
             print(f"Error connecting to {self.address}: {e}")
         finally:
             if client.is_connected:
-                await client.stop_notify(NUS_TX_UUID)
+                await client.stop_notify(self.tx_char)
                 await client.disconnect()
                 print(f"Disconnected from {self.address[-5:]}.")
+            if drain_task is not None:
+                await stop_draining(drain_task, self.queue, self.process_notification)
+            if self.dropped:
+                print(f"Dropped {self.dropped} notifications from {self.address[-5:]}: queue full.")
             self.close_popup()
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
     # BLE device MAC address
     BLE_MAC_ADDRESS = "F3:D9:31:80:1B:0B"
     configurator = BLEConfigurator(BLE_MAC_ADDRESS)
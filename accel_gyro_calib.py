@@ -1,14 +1,24 @@
 import asyncio
+import logging
 from bleak import BleakClient, BleakError
+from connection_pool import drain_notifications, negotiate_mtu, pack_commands, parse_accuracy, request_fast_connection, stop_draining
 import tkinter as tk
-from threading import Thread
 import time
 
+logger = logging.getLogger(__name__)
+
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e" # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+ACK_TOKEN = b"Executing"  # Text the device prints when it starts running a command
+ACK_TIMEOUT = 0.5  # Max seconds to wait for the ack before sending the next command
+QUEUE_SIZE = 4096  # Notifications buffered between the notify callback and the drain task
+GYRO_PREFIX = b"Gyro Accuracy"  # Notification carrying the gyro calibration accuracy (0-3)
+ACCEL_PREFIX = b"Accel Accuracy"  # Notification carrying the accel calibration accuracy (0-3)
+POPUP_REFRESH = 0.05  # Seconds between Tk event pumps while a popup is open
+
 
 class BLEConfigurator:
     """
@@ -17,15 +27,24 @@ class BLEConfigurator:
 
     def __init__(self, address):
         self.address = address
-        self.response_log = [] 
+        self.write_len = BLE_GATT_WRITE_LEN  # Raised by negotiate_mtu once connected
+        self.rx_char = None  # NUS characteristics resolved once on connect
+        self.tx_char = None
+        self.write_response = True  # Cleared when RX accepts write-without-response
+        self.conn_params = None  # Preferred connection parameters request, when the OS supports it
+        self.ack = asyncio.Event()
+        self.acks_pending = 0  # Acks still owed for the commands in the last write
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.dropped = 0
         self.popup_active = False
         self.popup_root = None
+        self.popup_task = None
         self.commands = [
-            "crt",                  # Command to trigger crt
-            "-f l",                 # Command to enable ImuX
-            "-l 1 qoq.bin",       # Command to create log file
-            "actse 52 100",         # Command to activate accelerometer corrected sensor
-            "actse 54 100"          # Command to activate gyroscope corrected sensor
+            b"crt\n",               # Command to trigger crt
+            b"-f l\n",              # Command to enable ImuX
+            b"-l 1 qoq.bin\n",    # Command to create log file
+            b"actse 52 100\n",      # Command to activate accelerometer corrected sensor
+            b"actse 54 100\n"       # Command to activate gyroscope corrected sensor
         ]
         self.gyro_calibration_start_time = None
         self.gyro_calibration_end_time = None  
@@ -45,7 +64,19 @@ class BLEConfigurator:
             justify="center"
         )
         label.pack(expand=True)
-        self.popup_root.mainloop()
+        self.popup_task = asyncio.create_task(self.pump_popup())
+
+    async def pump_popup(self):
+        """
+        Keep the pop-up responsive by processing Tk events from the asyncio loop.
+        """
+        while self.popup_active:
+            try:
+                self.popup_root.update()
+            except tk.TclError:
+                self.popup_active = False  # Window was closed by the user
+                break
+            await asyncio.sleep(POPUP_REFRESH)
 
     def close_popup(self):
         """
@@ -55,60 +86,77 @@ class BLEConfigurator:
             self.popup_root.destroy()
             self.popup_active = False
 
-    async def nus_data_rcv_handler(self, sender, data):
+    def nus_data_rcv_handler(self, sender, data):
+        """
+        Count acks and hand the notification to the drain task so Bleak is never held up.
+        """
+        if ACK_TOKEN in data:
+            # A packed write runs several commands; wait for one ack per line
+            self.acks_pending -= data.count(ACK_TOKEN)
+            if self.acks_pending <= 0:
+                self.ack.set()
+        try:
+            self.queue.put_nowait(bytes(data))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def process_notification(self, data):
         """
-        Handle incoming notifications from the BLE device.
+        Handle a notification from the BLE device.
         """
-        decoded_data = data.decode('utf-8').strip()
-        print(f"[Received from {sender}]: {decoded_data}")
-        self.response_log.append(decoded_data)
+        raw = data.rstrip()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[Received from %s]: %s", self.address[-5:], data.decode('utf-8', errors='ignore').strip())
+
+        accuracy = parse_accuracy(raw, GYRO_PREFIX)
 
         # Checking for accelerometer calibration accuracy
-        if "Gyro Accuracy" in decoded_data:
-            accuracy = int(decoded_data.split()[-1])
-            if accuracy == 3 and not self.popup_active:
-                print("Accelerometer accuracy 1 reached. Showing calibration guidance.")
-                popup_thread = Thread(target=self.show_popup)
-                popup_thread.start()
-        if "Accel Accuracy" in decoded_data:
-            accuracy = int(decoded_data.split()[-1])
-            if accuracy == 3:
-                self.close_popup()
+        if accuracy == 3 and not self.popup_active:
+            print("Accelerometer accuracy 1 reached. Showing calibration guidance.")
+            self.show_popup()
+        if parse_accuracy(raw, ACCEL_PREFIX) == 3:
+            self.close_popup()
 
         # Checking for gyroscope calibration accuracy and track time
-        if "Gyro Accuracy" in decoded_data:
-            accuracy = int(decoded_data.split()[-1])
-            if accuracy == 1 and self.gyro_calibration_start_time is None:
-                # Recorded start time when Gyro Accuracy reaches 1
-                self.gyro_calibration_start_time = time.time()
-                print("Gyroscope calibration started...")
-            elif accuracy == 3 and self.gyro_calibration_start_time is not None:
-                # Recorded end time when Gyro Accuracy reaches 3
-                self.gyro_calibration_end_time = time.time()
-                calibration_time = self.gyro_calibration_end_time - self.gyro_calibration_start_time
-                print(f"Gyroscope calibration completed. Time taken: {calibration_time:.2f} seconds.")
-                self.gyro_calibration_start_time = None
+        if accuracy == 1 and self.gyro_calibration_start_time is None:
+            # Recorded start time when Gyro Accuracy reaches 1
+            self.gyro_calibration_start_time = time.time()
+            print("Gyroscope calibration started...")
+        elif accuracy == 3 and self.gyro_calibration_start_time is not None:
+            # Recorded end time when Gyro Accuracy reaches 3
+            self.gyro_calibration_end_time = time.time()
+            calibration_time = self.gyro_calibration_end_time - self.gyro_calibration_start_time
+            print(f"Gyroscope calibration completed. Time taken: {calibration_time:.2f} seconds.")
+            self.gyro_calibration_start_time = None
+
+    async def wait_for_ack(self):
+        """
+        Wait until the device acks the last command, or ACK_TIMEOUT for devices that stay silent.
+        """
+        try:
+            await asyncio.wait_for(self.ack.wait(), timeout=ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
 
     async def send_command(self, client, command):
         """
-        Send a single command to the BLE device.
+        Send one or more newline-terminated bytes commands to the BLE device.
         """
-        print(f"[Sending to {self.address[-5:]}]: {command}")
-        if len(command) <= BLE_GATT_WRITE_LEN:
-            await client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        else:
-            for i in range(0, len(command), BLE_GATT_WRITE_LEN):
-                await client.write_gatt_char(NUS_RX_UUID, command[i:i + BLE_GATT_WRITE_LEN].encode())
-        
-        # Waiting briefly to allow the BLE device to process and respond
-        await asyncio.sleep(0.5)
+        logger.debug("[Sending to %s]: %s", self.address[-5:], command.decode().rstrip())
+        # Commands arrive newline-terminated as bytes; slice views of the same buffer for each write
+        payload = memoryview(command)
+        self.acks_pending = command.count(b"\n")
+        self.ack.clear()
+        for i in range(0, len(payload), self.write_len):
+            await client.write_gatt_char(self.rx_char, payload[i:i + self.write_len], response=self.write_response)
+        await self.wait_for_ack()
 
     async def configure_device(self, client):
         """
-        Send configuration commands to the BLE device.
+        Send configuration commands to the BLE device, packing as many as fit into each GATT write.
         """
-        for command in self.commands:
-            await self.send_command(client, command)
+        for payload in pack_commands(self.commands, self.write_len):
+            await self.send_command(client, payload)
 
     async def continuous_stream(self, client):
         """
@@ -126,13 +174,20 @@ class BLEConfigurator:
         Main function to connect to the BLE device, send commands, and stream data.
         """
         client = BleakClient(self.address)
+        drain_task = None
         try:
             await client.connect()
             if client.is_connected:
                 print(f"Connected to {self.address[-5:]} ({self.address})")
+                self.conn_params = request_fast_connection(client)
+                self.write_len = await negotiate_mtu(client)
+                self.rx_char = client.services.get_characteristic(NUS_RX_UUID)
+                self.tx_char = client.services.get_characteristic(NUS_TX_UUID)
+                self.write_response = "write-without-response" not in self.rx_char.properties
 
                 # Starting to receiving notifications
-                await client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
+                drain_task = asyncio.create_task(drain_notifications(self.queue, self.process_notification))
+                await client.start_notify(self.tx_char, self.nus_data_rcv_handler)
 
                 # Sending configuration commands
                 print("Sending configuration commands...")
@@ -145,12 +200,17 @@ class BLEConfigurator:
             print(f"Error connecting to {self.address}: {e}")
         finally:
             if client.is_connected:
-                await client.stop_notify(NUS_TX_UUID)
+                await client.stop_notify(self.tx_char)
                 await client.disconnect()
                 print(f"Disconnected from {self.address[-5:]}.")
+            if drain_task is not None:
+                await stop_draining(drain_task, self.queue, self.process_notification)
+            if self.dropped:
+                print(f"Dropped {self.dropped} notifications from {self.address[-5:]}: queue full.")
             self.close_popup()
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
 
     # BLE device MAC address
     BLE_MAC_ADDRESS = "F3:D9:31:80:1B:0B"  
@@ -1,20 +1,54 @@
 import asyncio
+import logging
 import os
-import re
-import subprocess
 import pandas as pd
 from bleak import BleakClient, BleakError
+from connection_pool import negotiate_mtu, receive_file
+
+logger = logging.getLogger(__name__)
 
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"  # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+BLE_CONN_INTERVAL = 0.02  # Approximate BLE connection interval in seconds
+
+# Header that marks the start of valid sensor data in the .bin file: "1.0", whitespace, then these fields in order
+HEADER_VERSION = b"1.0"
+HEADER_FIELDS = (b"1: Accelerometer (g):", b"2: Gyroscope (dps):", b"3: IMU Temperature (C):")
+
+
+def find_header(content):
+    """
+    Return the offset of the data header in content, or -1 if it is not there.
+    """
+    i = content.find(HEADER_FIELDS[0])
+    while i >= 0:
+        start = content.rfind(HEADER_VERSION, 0, i)
+        if start >= 0 and content[start + len(HEADER_VERSION):i].isspace():
+            pos = i
+            for field in HEADER_FIELDS[1:]:
+                pos = content.find(field, pos)
+                if pos < 0:
+                    return -1
+            return start
+        i = content.find(HEADER_FIELDS[0], i + 1)
+    return -1
+
+
+def encode_command(command, write_len=BLE_GATT_WRITE_LEN):
+    """
+    Encode a command with its trailing newline and split it into fragments of at most write_len bytes.
+    """
+    payload = (command + '\n').encode()
+    return tuple(payload[i:i + write_len] for i in range(0, len(payload), write_len))
 
 
 class BLEFileHandler:
     def __init__(self, address):
         self.address = address
+        self.write_len = BLE_GATT_WRITE_LEN  # Raised by negotiate_mtu once connected
         self.output_dir = "output"
         os.makedirs(self.output_dir, exist_ok=True)
 
@@ -22,52 +56,19 @@ class BLEFileHandler:
         """
         Send a command to the BLE device.
         """
-        print(f"[Sending to {self.address[-5:]}]: {command}")
-        if len(command) <= BLE_GATT_WRITE_LEN:
-            await client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        else:
-            for i in range(0, len(command), BLE_GATT_WRITE_LEN):
-                await client.write_gatt_char(NUS_RX_UUID, command[i:i + BLE_GATT_WRITE_LEN].encode())
-        await asyncio.sleep(0.5)
+        logger.debug("[Sending to %s]: %s", self.address[-5:], command)
+        for fragment in encode_command(command, self.write_len):
+            await client.write_gatt_char(NUS_RX_UUID, fragment, response=False)
+        # No notification handler is active here to see an ack, so only give the link one interval
+        await asyncio.sleep(BLE_CONN_INTERVAL)
 
     async def read_large_binary_file(self, client, file_name, max_size_mb=10):
         """
         Read a large binary file (up to max_size_mb) from the BLE device via notifications.
         """
-        max_size_bytes = max_size_mb * 1024 * 1024  # Converting MB to bytes
         local_path = os.path.join(self.output_dir, file_name)
-        file_data = bytearray()  # storing incoming binary data
-
-        def notification_handler(sender, data):
-            nonlocal file_data
-            decoded_data = data.decode(errors="ignore").strip()
-            if not decoded_data.startswith(("rd", "Executing rd")):
-                file_data.extend(data)  # Appending only valid binary data
-                print(f"Received {len(data)} bytes of file data. Total: {len(file_data)} bytes.")
-            else:
-                print(f"Filtered out log message: {decoded_data}")
-
         print(f"Requesting file {file_name} from BLE device...")
-        await client.start_notify(NUS_TX_UUID, notification_handler)
-
-        # Sending `rd` command to read the file
-        await client.write_gatt_char(NUS_RX_UUID, f"rd {file_name}\n".encode())
-
-        # Waiting for the file to be transferred
-        timeout = 30  # Adjust as per the expected transfer speed
-        for _ in range(timeout):
-            await asyncio.sleep(1)
-            if len(file_data) >= max_size_bytes:
-                print(f"File transfer limit of {max_size_mb} MB reached. Stopping...")
-                break
-
-        await client.stop_notify(NUS_TX_UUID)
-
-        # Save the received data to a local file
-        with open(local_path, "wb") as f:
-            f.write(file_data)
-
-        print(f"File saved to {local_path} ({len(file_data)} bytes received)")
+        self.total_bytes = await receive_file(client, local_path, file_name, max_size_mb=max_size_mb)
         return local_path
 
     def clean_bin_file(self, bin_file):
@@ -78,30 +79,19 @@ class BLEFileHandler:
         with open(bin_file, "rb") as f:
             content = f.read()
 
-        # Decode the binary content to text for processing
-        decoded_content = content.decode(errors="ignore")
-
-        # Find the starting point of the valid header using regex
-        match = re.search(
-            r"1\.0\s+1: Accelerometer \(g\):.*?2: Gyroscope \(dps\):.*?3: IMU Temperature \(C\):", 
-            decoded_content,
-            re.DOTALL
-        )
+        # Find the starting point of the valid header directly in the raw bytes
+        valid_start = find_header(content)
 
-        if match:
-            # Extract valid content from the starting point
-            valid_start = match.start()
-            valid_content = content[valid_start:]
-
-            # Overwrite the .bin file with the cleaned content
+        if valid_start >= 0:
+            # Overwrite the .bin file with the content from the starting point, without copying it
             with open(bin_file, "wb") as f:
-                f.write(valid_content)
+                f.write(memoryview(content)[valid_start:])
 
             print("Binary file cleaned successfully.")
         else:
             raise ValueError("Valid header not found in the binary file. File might be corrupted.")
 
-    def convert_bin_to_csv(self, bin_file):
+    async def convert_bin_to_csv(self, bin_file):
         """
         Convert the binary file to CSV using udf2csv.exe.
         """
@@ -113,15 +103,16 @@ class BLEFileHandler:
 
         print(f"Converting {bin_file} to CSV using {exe_path}...")
         try:
-            # Use subprocess to run udf2csv.exe
-            result = subprocess.run(
-                [exe_path, bin_file],
-                capture_output=True,
-                text=True
+            # Run udf2csv.exe without blocking the event loop; only stderr is needed, and only on failure
+            proc = await asyncio.create_subprocess_exec(
+                exe_path, bin_file,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
             )
+            _, err = await proc.communicate()
 
-            if result.returncode != 0:
-                print(f"Error during conversion: {result.stderr}")
+            if proc.returncode != 0:
+                print(f"Error during conversion: {err.decode(errors='ignore')}")
                 raise RuntimeError("Failed to convert .bin to .csv")
 
             print(f"CSV file created: {csv_file}")
@@ -131,6 +122,14 @@ class BLEFileHandler:
             print(f"Error during conversion: {e}")
             raise
 
+    async def process_bin_file(self, bin_file):
+        """
+        Clean the received .bin file and convert it to CSV, returning the CSV path.
+        """
+        # Clean the binary file off the event loop; it reads and rewrites the whole file
+        await asyncio.to_thread(self.clean_bin_file, bin_file)
+        return await self.convert_bin_to_csv(bin_file)
+
     def validate_csv(self, csv_file):
         """
         Validate the contents of the CSV file by loading it into a DataFrame and printing the first few rows.
@@ -153,15 +152,14 @@ class BLEFileHandler:
             await client.connect()
             if client.is_connected:
                 print(f"Connected to {self.address[-5:]} ({self.address})")
+                self.write_len = await negotiate_mtu(client)
 
                 # Read binary file from the BLE device
                 bin_file = await self.read_large_binary_file(client, file_name)
 
-                # Clean the binary file
-                self.clean_bin_file(bin_file)
-
-                # Convert the binary file to CSV
-                csv_file = self.convert_bin_to_csv(bin_file)
+                # Nothing else is read from the device; disconnect while the file is cleaned and converted
+                csv_file, _ = await asyncio.gather(self.process_bin_file(bin_file), client.disconnect())
+                print(f"Disconnected from {self.address[-5:]}.")
 
                 # Validate the CSV file
                 self.validate_csv(csv_file)
@@ -176,6 +174,7 @@ class BLEFileHandler:
             
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
     # BLE device MAC address
     BLE_MAC_ADDRESS = "F3:D9:31:80:1B:0B"
 
@@ -1,13 +1,32 @@
 import asyncio
+import logging
 from bleak import BleakClient, BleakError
+from connection_pool import negotiate_mtu
 import time
 import tkinter as tk
 
+logger = logging.getLogger(__name__)
+
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"  # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+ACK_TOKEN = "Executing"  # Text the device prints when it starts running a command
+ACK_TIMEOUT = 1.0  # Max seconds to wait for the ack before sending the next command
+ACTIVATE_COMMAND = "actse"  # Sensor activations are independent and can be sent back to back
+ACCURACY_TOKEN = b"Accuracy"  # Present in every calibration accuracy notification
+GYRO_PREFIX = "Gyro Accuracy"  # Notification carrying the gyro calibration accuracy (0-3)
+ACCEL_PREFIX = "Accel Accuracy"  # Notification carrying the accel calibration accuracy (0-3)
+POPUP_REFRESH = 0.05  # Seconds between Tk event pumps while a popup is open
+
+
+def encode_command(command, write_len=BLE_GATT_WRITE_LEN):
+    """
+    Encode a command with its trailing newline and split it into fragments of at most write_len bytes.
+    """
+    payload = (command + '\n').encode()
+    return tuple(payload[i:i + write_len] for i in range(0, len(payload), write_len))
 
 
 class BLEConfigurator:
@@ -18,6 +37,9 @@ class BLEConfigurator:
     def __init__(self, address):
         self.address = address
         self.response_log = []  # Log for received responses
+        self.write_len = BLE_GATT_WRITE_LEN  # Raised by negotiate_mtu once connected
+        self.ack = asyncio.Event()
+        self.acks_pending = 0  # Acks still owed for the commands in the last send
         self.commands = [
             "crt",                  # Command to trigger crt
             "-f l",                 # Command to enable ImuX
@@ -26,10 +48,12 @@ class BLEConfigurator:
             "actse 54 100",         # Command to activate gyroscope corrected sensor
             "actse 13 100"         # Command to activate orientation virtual sensor
         ]
+        self.encoded_commands = {command: encode_command(command) for command in self.commands}  # Fragments built once
         self.gyro_calibration_start_time = None
         self.gyro_calibration_end_time = None
         self.popup_active = False
         self.popup_root = None
+        self.popup_task = None
         self.heading_test_started = False
 
     def show_popup(self):
@@ -50,7 +74,22 @@ class BLEConfigurator:
         self.stop_button = tk.Button(self.popup_root, text="Stop", command=self.stop_heading, state="disabled")
         self.stop_button.pack(pady=10)
 
-        self.popup_root.mainloop()
+        # Pump Tk from the event loop instead of mainloop() so BLE notifications keep flowing
+        self.popup_task = asyncio.create_task(self.pump_popup())
+
+    async def pump_popup(self):
+        """
+        Keep the pop-up responsive by processing Tk events from the asyncio loop.
+        """
+        while self.popup_active:
+            try:
+                self.popup_root.update()
+            except tk.TclError:
+                # Window was closed by the user
+                self.popup_active = False
+                self.popup_root = None
+                break
+            await asyncio.sleep(POPUP_REFRESH)
 
     def start_heading(self):
         """
@@ -83,12 +122,20 @@ class BLEConfigurator:
         Handle incoming notifications from the BLE device.
         """
         decoded_data = data.decode('utf-8').strip()
-        print(f"[Received from {sender}]: {decoded_data}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[Received from %s]: %s", self.address[-5:], decoded_data)
         self.response_log.append(decoded_data)
+        if ACK_TOKEN in decoded_data:
+            # A batched send runs several commands; wait for one ack per command
+            self.acks_pending -= decoded_data.count(ACK_TOKEN)
+            if self.acks_pending <= 0:
+                self.ack.set()
+        if ACCURACY_TOKEN not in data:
+            return
 
         # Check for accelerometer and gyroscope calibration accuracy
-        if "Gyro Accuracy" in decoded_data:
-            accuracy = int(decoded_data.split()[-1])
+        if decoded_data.startswith(GYRO_PREFIX):
+            accuracy = int(decoded_data.rsplit(None, 1)[-1])
             if accuracy == 1 and self.gyro_calibration_start_time is None:
                 # Record start time when Gyro Accuracy reaches 1
                 self.gyro_calibration_start_time = time.time()
@@ -99,37 +146,59 @@ class BLEConfigurator:
                 calibration_time = self.gyro_calibration_end_time - self.gyro_calibration_start_time
                 print(f"Gyroscope calibration completed. Time taken: {calibration_time:.2f} seconds.")
                 self.gyro_calibration_start_time = None
-
-        if "Accel Accuracy" in decoded_data:
-            accuracy = int(decoded_data.split()[-1])
+        elif decoded_data.startswith(ACCEL_PREFIX):
+            accuracy = int(decoded_data.rsplit(None, 1)[-1])
             if accuracy == 3:
                 print("Accelerometer calibration completed.")
                 # Show the pop-up once calibration is complete
                 if not self.popup_active:
                     self.show_popup()
 
+    async def wait_for_ack(self):
+        """
+        Wait until the device acks the last command, or ACK_TIMEOUT for devices that stay silent.
+        """
+        try:
+            await asyncio.wait_for(self.ack.wait(), timeout=ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
     async def send_command(self, client, command):
         """
         Send a single command to the BLE device.
         """
-        print(f"[Sending to {self.address[-5:]}]: {command}")
+        logger.debug("[Sending to %s]: %s", self.address[-5:], command)
 
-        # Send command in chunks if necessary
-        if len(command) <= BLE_GATT_WRITE_LEN:
-            await client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        else:
-            for i in range(0, len(command), BLE_GATT_WRITE_LEN):
-                await client.write_gatt_char(NUS_RX_UUID, command[i:i + BLE_GATT_WRITE_LEN].encode())
+        self.acks_pending = 1
+        self.ack.clear()
+        # Send the pre-encoded fragments without waiting for a GATT response per fragment
+        fragments = self.encoded_commands.get(command) or encode_command(command, self.write_len)
+        for fragment in fragments:
+            await client.write_gatt_char(NUS_RX_UUID, fragment, response=False)
+        await self.wait_for_ack()
 
-        # Wait briefly to allow the BLE device to process and respond
-        await asyncio.sleep(1)
+    async def send_commands(self, client, commands):
+        """
+        Send independent commands back to back and wait once for all of their acks.
+        """
+        self.acks_pending = len(commands)
+        self.ack.clear()
+        for command in commands:
+            logger.debug("[Sending to %s]: %s", self.address[-5:], command)
+            fragments = self.encoded_commands.get(command) or encode_command(command, self.write_len)
+            for fragment in fragments:
+                await client.write_gatt_char(NUS_RX_UUID, fragment, response=False)
+        await self.wait_for_ack()
 
     async def configure_device(self, client):
         """
         Send configuration commands to the BLE device.
         """
+        activations = [command for command in self.commands if command.startswith(ACTIVATE_COMMAND)]
         for command in self.commands:
-            await self.send_command(client, command)
+            if not command.startswith(ACTIVATE_COMMAND):
+                await self.send_command(client, command)
+        await self.send_commands(client, activations)
 
     async def continuous_stream(self, client):
         """
@@ -153,6 +222,8 @@ class BLEConfigurator:
             await client.connect()
             if client.is_connected:
                 print(f"Connected to {self.address[-5:]} ({self.address})")
+                self.write_len = await negotiate_mtu(client)
+                self.encoded_commands = {command: encode_command(command, self.write_len) for command in self.commands}
 
                 # Starting to receive notifications
                 await client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
@@ -177,6 +248,7 @@ class BLEConfigurator:
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
     # BLE device MAC address
     BLE_MAC_ADDRESS = "F3:D9:31:80:1B:0B"
 
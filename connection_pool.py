@@ -0,0 +1,280 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from bleak import BleakClient
+
+try:
+    from winrt.windows.devices.bluetooth import BluetoothLEPreferredConnectionParameters
+except ImportError:  # Not on Windows 11, or bleak is on the older bleak_winrt bindings
+    BluetoothLEPreferredConnectionParameters = None
+
+logger = logging.getLogger(__name__)
+
+CONNECT_SEMAPHORE = asyncio.Semaphore(1)  # Connects in flight per BLE adapter
+DRAIN_BATCH = 64  # Notifications processed per drain pass
+BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+MAX_GATT_WRITE_LEN = 244  # Max length for GATT writes once a larger MTU is negotiated
+DEFAULT_ATT_MTU = 23  # ATT MTU before any exchange has completed
+MTU_EXCHANGE_TIMEOUT = 1.0  # Max seconds to wait for a backend that exchanges the MTU on its own
+NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
+NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
+TRANSFER_TIMEOUT = 30  # Upper bound in seconds on a whole file transfer
+TRANSFER_IDLE_TIMEOUT = 2.0  # Seconds without notifications, once the file is flowing, before a transfer is considered complete
+PROGRESS_STEP = 64 * 1024  # Bytes between file transfer progress messages
+LOG_PREFIXES = (b"rd", b"Executing rd")  # Device log lines interleaved with file data
+LOG_PREFIX_SCAN = 32  # Leading bytes of a notification checked for LOG_PREFIXES
+HEADER_TAIL_LEN = 4096  # Pre-header bytes kept between notifications; must exceed the full data header
+
+
+class BLEConnectionPool:
+    """
+    Keeps one connected BleakClient per device address so that successive
+    phases (configuration, calibration, file read) can share a connection.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._locks = {}
+
+    async def get(self, address):
+        """
+        Return a connected client for the address, connecting it on first use.
+        """
+        lock = self._locks.setdefault(address, asyncio.Lock())
+        async with lock:
+            client = self._clients.get(address)
+            if client is None or not client.is_connected:
+                client = BleakClient(address)
+                # BlueZ rejects a second connect while one is in progress on the adapter
+                async with CONNECT_SEMAPHORE:
+                    await client.connect()
+                self._clients[address] = client
+            return client
+
+    @asynccontextmanager
+    async def acquire(self, address):
+        """
+        Borrow the pooled client for the address. The connection stays open on exit.
+        """
+        yield await self.get(address)
+
+    async def release(self, address):
+        """
+        Disconnect the pooled client for the address and drop it from the pool.
+        """
+        client = self._clients.pop(address, None)
+        if client is not None:
+            await client.disconnect()
+            print(f"Disconnected from {address[-5:]}.")
+
+    async def close(self):
+        """
+        Disconnect every pooled client.
+        """
+        for address in list(self._clients):
+            try:
+                await self.release(address)
+            except Exception as e:
+                print(f"Error disconnecting from {address}: {e}")
+
+
+def process_safely(process, data):
+    """
+    Run process on one notification, logging any error so a bad packet only loses itself.
+    """
+    try:
+        process(data)
+    except Exception:
+        logger.exception("Failed to process notification %r", data)
+
+
+async def drain_notifications(queue, process):
+    """
+    Feed queued notifications to process in batches, yielding to the loop between batches.
+    """
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < DRAIN_BATCH and not queue.empty():
+            batch.append(queue.get_nowait())
+        for data in batch:
+            process_safely(process, data)
+        await asyncio.sleep(0)
+
+
+async def stop_draining(task, queue, process):
+    """
+    Cancel a drain_notifications task, surface any error it died with, then process what is still queued.
+    """
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    while not queue.empty():
+        process_safely(process, queue.get_nowait())
+
+
+def parse_accuracy(data, prefix):
+    """
+    Return the accuracy digit ending a raw "<prefix> ... N" notification, or None if data is not one.
+    Trailing whitespace and line endings are ignored.
+    """
+    if prefix not in data:
+        return None
+    digit = data.rstrip()[-1:]
+    return digit[0] - 0x30 if digit.isdigit() else None
+
+
+def pack_commands(commands, limit):
+    """
+    Greedily join newline-terminated commands into as few payloads of at most limit bytes as possible.
+    """
+    payloads = []
+    buf = b""
+    for command in commands:
+        if buf and len(buf) + len(command) > limit:
+            payloads.append(buf)
+            buf = b""
+        buf += command
+    if buf:
+        payloads.append(buf)
+    return payloads
+
+
+# Bleak has no public API for the two link tweaks below, so they go through backend internals.
+# These two accessors are the only places that touch them. Each feature-detects with getattr/hasattr,
+# so a bleak release that renames or drops a private falls back to the OS defaults instead of failing.
+
+def _winrt_device(client):
+    """
+    Return the WinRT BluetoothLEDevice behind client, or None on other backends or bleak layouts.
+    Uses the private BleakClientWinRT._requester.
+    """
+    return getattr(getattr(client, "_backend", None), "_requester", None)
+
+
+def _mtu_exchanger(client):
+    """
+    Return a coroutine function that runs the ATT MTU exchange for client, or None where the backend does it itself.
+    Uses the private BleakClientBlueZDBus._acquire_mtu; WinRT exchanges the MTU on its own after connecting.
+    """
+    return getattr(getattr(client, "_backend", None), "_acquire_mtu", None)
+
+
+def request_fast_connection(client):
+    """
+    Ask the OS for a short connection interval and return the request, or None if it is not supported.
+    """
+    device = _winrt_device(client)
+    if BluetoothLEPreferredConnectionParameters is None or device is None:
+        return None
+    try:
+        # Hold the returned request for the life of the connection; Windows reverts the interval once it is closed
+        return device.request_preferred_connection_parameters(
+            BluetoothLEPreferredConnectionParameters.throughput_optimized)
+    except (AttributeError, OSError) as e:
+        logger.warning("Connection interval request failed, keeping OS default: %s", e)
+        return None
+
+
+async def negotiate_mtu(client):
+    """
+    Request the largest ATT MTU the link supports and return the GATT write length that fits it.
+    """
+    acquire_mtu = _mtu_exchanger(client)
+    if acquire_mtu is not None:
+        try:
+            await acquire_mtu()
+        except Exception as e:
+            logger.warning("MTU exchange failed, keeping default write size: %s", e)
+    else:
+        # WinRT exchanges the MTU by itself shortly after connecting; let it land before sizing writes
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + MTU_EXCHANGE_TIMEOUT
+        while client.mtu_size <= DEFAULT_ATT_MTU and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+    write_len = max(BLE_GATT_WRITE_LEN, min(client.mtu_size - 3, MAX_GATT_WRITE_LEN))
+    logger.info("MTU: %d, GATT write length: %d", client.mtu_size, write_len)
+    return write_len
+
+
+def is_log_line(data):
+    """
+    Return True if a notification is a device log line rather than file data, checking only its leading raw bytes.
+    """
+    return data[:LOG_PREFIX_SCAN].lstrip().startswith(LOG_PREFIXES)
+
+
+async def receive_file(client, path, file_name, *, rx_char=NUS_RX_UUID, tx_char=NUS_TX_UUID, response=None,
+                       max_size_mb=10, is_log=is_log_line, find_header=None):
+    """
+    Request file_name with "rd" and write the notifications carrying it straight into path.
+    The transfer ends once the device goes quiet, at max_size_mb, or after TRANSFER_TIMEOUT.
+    With find_header, bytes before the data header are dropped and ValueError is raised if it never arrives.
+    Returns the number of file data bytes received.
+    """
+    max_size_bytes = max_size_mb * 1024 * 1024
+    loop = asyncio.get_running_loop()
+    done = asyncio.Event()
+    total = 0
+    last_rx = None
+    idle_timer = None
+    pending = bytearray()  # Tail of the pre-header stream, so a header split across notifications is still found
+    header_found = find_header is None
+
+    def check_idle():
+        # A single timer per transfer: rather than rescheduling on every notification, it re-arms for the time left
+        nonlocal idle_timer
+        remaining = last_rx + TRANSFER_IDLE_TIMEOUT - loop.time()
+        if remaining > 0:
+            idle_timer = loop.call_later(remaining, check_idle)
+        else:
+            print(f"No data received for {TRANSFER_IDLE_TIMEOUT} seconds. Transfer complete.")
+            done.set()
+
+    with open(path, "wb", buffering=1 << 20) as f:
+        def notification_handler(sender, data):
+            nonlocal total, last_rx, idle_timer, header_found
+            last_rx = loop.time()
+            if idle_timer is None:
+                # The idle timer starts with the first notification; TRANSFER_TIMEOUT covers a device that stays silent
+                idle_timer = loop.call_later(TRANSFER_IDLE_TIMEOUT, check_idle)
+            if is_log(data):
+                logger.debug("Filtered out log message: %s", data.decode(errors="ignore").strip())
+                return
+            if header_found:
+                f.write(data)
+            else:
+                pending.extend(data)
+                start = find_header(pending)
+                if start >= 0:
+                    f.write(pending[start:])
+                    header_found = True
+                    pending.clear()
+                else:
+                    del pending[:-HEADER_TAIL_LEN]
+            total += len(data)
+            if total // PROGRESS_STEP != (total - len(data)) // PROGRESS_STEP:
+                print(f"Received {total} bytes of file data.")
+            if total >= max_size_bytes:
+                done.set()
+
+        await client.start_notify(tx_char, notification_handler)
+        try:
+            await client.write_gatt_char(rx_char, f"rd {file_name}\n".encode(), response=response)
+            await asyncio.wait_for(done.wait(), TRANSFER_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"File transfer timed out after {TRANSFER_TIMEOUT} seconds. Stopping...")
+        finally:
+            if idle_timer is not None:
+                idle_timer.cancel()
+        if total >= max_size_bytes:
+            print(f"File transfer limit of {max_size_mb} MB reached. Stopping...")
+        await client.stop_notify(tx_char)
+    if not header_found:
+        raise ValueError("Valid header not found in the received data. File might be corrupted.")
+    print(f"File saved to {path} ({total} bytes received)")
+    return total
+
+
+pool = BLEConnectionPool()
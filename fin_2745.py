@@ -1,15 +1,24 @@
 import asyncio
+import logging
 import os
 import re
-import subprocess
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 from bleak import BleakClient, BleakError
+from connection_pool import negotiate_mtu, receive_file
+
+logger = logging.getLogger(__name__)
 
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"  # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+ACK_TOKEN = "Executing"  # Text the device prints when it starts running a command
+ACK_TIMEOUT = 0.5  # Max seconds to wait for the ack before sending the next command
+HEADER_RE = re.compile(rb"1\.0\s*\n1:\s*Accelerometer.*?\n", re.DOTALL)  # Header that marks the start of the valid data
+CSV_CHUNK_ROWS = 65536  # Rows parsed per chunk while validating the CSV
+PLOT_BUCKET = 100  # Samples per HTML plot bucket; each keeps its min and max so short dips and spikes still show
 
 class BLEHandler:
     def __init__(self, address):
@@ -17,16 +26,21 @@ class BLEHandler:
         self.client = BleakClient(self.address)
         self.accel_calibration_complete = False
         self.response_log = []
+        self.write_len = BLE_GATT_WRITE_LEN  # Raised by negotiate_mtu once connected
+        self.ack = asyncio.Event()
         self.output_dir = "output"
         os.makedirs(self.output_dir, exist_ok=True)
 
     async def nus_data_rcv_handler(self, sender, data):
         try:
             decoded_data = data.decode('utf-8').strip()
-            print(f"[Received]: {decoded_data}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[Received]: %s", decoded_data)
             self.response_log.append(decoded_data)
+            if ACK_TOKEN in decoded_data:
+                self.ack.set()
             if "Accel Accuracy" in decoded_data:
-                accuracy = int(decoded_data.split()[-1])
+                accuracy = int(decoded_data.rsplit(None, 1)[-1])
                 if accuracy == 3:
                     print("Accelerometer calibration complete.")
                     self.accel_calibration_complete = True
@@ -36,15 +50,26 @@ class BLEHandler:
             print(f"Hex representation: {decoded_data}")
         return decoded_data
 
+    async def wait_for_ack(self):
+        """Wait until the device acks the last command, or ACK_TIMEOUT for devices that stay silent."""
+        try:
+            await asyncio.wait_for(self.ack.wait(), timeout=ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
     async def send_command(self, command):
-        print(f"[Sending]: {command}")
-        await self.client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        await asyncio.sleep(0.5)
+        logger.debug("[Sending]: %s", command)
+        self.ack.clear()
+        payload = memoryview((command + '\n').encode())
+        for i in range(0, len(payload), self.write_len):
+            await self.client.write_gatt_char(NUS_RX_UUID, payload[i:i + self.write_len], response=False)
+        await self.wait_for_ack()
 
     async def log_data(self):
         try:
             await self.client.connect()
             print("Connected to device.")
+            self.write_len = await negotiate_mtu(self.client)
             await self.client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
             await self.send_command("crt")
             await self.send_command("-f l")
@@ -60,58 +85,41 @@ class BLEHandler:
             print(f"Error: {e}")
 
     async def read_large_binary_file(self, file_name, max_size_mb=10):
-        max_size_bytes = max_size_mb * 1024 * 1024
+        """
+        Read a large binary file (up to max_size_mb) from the BLE device via notifications.
+        """
         local_path = os.path.join(self.output_dir, file_name)
-        file_data = bytearray()
-
-        def notification_handler(sender, data):
-            nonlocal file_data
-            decoded_data = data.decode(errors="ignore").strip()
-            if not decoded_data.startswith(("rd", "Executing rd")):
-                file_data.extend(data)
-                print(f"Received {len(data)} bytes of file data. Total: {len(file_data)} bytes.")
-            else:
-                print(f"Filtered out log message: {decoded_data}")
         print(f"Requesting file {file_name} from BLE device...")
-        await self.client.start_notify(NUS_TX_UUID, notification_handler)
-        await self.client.write_gatt_char(NUS_RX_UUID, f"rd {file_name}\n".encode())
-        timeout = 30
-        for _ in range(timeout):
-            await asyncio.sleep(1)
-            if len(file_data) >= max_size_bytes:
-                print(f"File transfer limit of {max_size_mb} MB reached. Stopping...")
-                break
-        await self.client.stop_notify(NUS_TX_UUID)
-        with open(local_path, "wb") as f:
-            f.write(file_data)
-        print(f"File saved to {local_path} ({len(file_data)} bytes received)")
+        self.total_bytes = await receive_file(self.client, local_path, file_name, max_size_mb=max_size_mb)
         return local_path
 
     def clean_bin_file(self, bin_file):
         print(f"Cleaning binary file: {bin_file}...")
         with open(bin_file, "rb") as f:
             content = f.read()
-        decoded_content = content.decode(errors="ignore")
-        match = re.search(r"1\.0\s*\n1:\s*Accelerometer.*?\n", decoded_content, re.DOTALL)
+        match = HEADER_RE.search(content)
         if match:
-            valid_start = match.start()
-            valid_content = content[valid_start:]
             with open(bin_file, "wb") as f:
-                f.write(valid_content)
+                f.write(memoryview(content)[match.start():])
             print("Binary file cleaned successfully.")
         else:
             raise ValueError("Valid header not found in the binary file. File might be corrupted.")
 
-    def convert_bin_to_csv(self, bin_file):
+    async def convert_bin_to_csv(self, bin_file):
         csv_file = os.path.splitext(bin_file)[0] + ".bin.csv"
         exe_path = os.path.join(os.getcwd(), "udf2csv.exe")
         if not os.path.exists(exe_path):
             raise FileNotFoundError(f"udf2csv.exe not found in {os.getcwd()}")
         print(f"Converting {bin_file} to CSV using {exe_path}...")
         try:
-            result = subprocess.run([exe_path, bin_file], capture_output=True, text=True)
-            if result.returncode != 0:
-                print(f"Error during conversion: {result.stderr}")
+            proc = await asyncio.create_subprocess_exec(
+                exe_path, bin_file,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            _, err = await proc.communicate()
+            if proc.returncode != 0:
+                print(f"Error during conversion: {err.decode(errors='ignore')}")
                 raise RuntimeError("Failed to convert .bin to .csv")
             print(f"CSV file created: {csv_file}")
             return csv_file
@@ -119,19 +127,52 @@ class BLEHandler:
             print(f"Error during conversion: {e}")
             raise
 
+    async def process_bin_file(self, bin_file):
+        """Clean the received .bin file and convert it to CSV, returning the CSV path"""
+        await asyncio.to_thread(self.clean_bin_file, bin_file)
+        return await self.convert_bin_to_csv(bin_file)
+
     def validate_csv(self, csv_file):
-        """Validate the contents of the CSV file by loading it into a DataFrame"""
-        print(f"Reading {csv_file} into a dataframe...")
-        df = pd.read_csv(csv_file)
-        df.columns = df.columns.str.strip()
+        """Validate the accel accuracy column of the CSV file one chunk at a time"""
+        print(f"Reading {csv_file} in chunks...")
         column_name = "Accel Corrected 0.a"
-        df[column_name] = pd.to_numeric(df[column_name], errors="coerce")       
-        if column_name in df.columns:
+        reader = pd.read_csv(csv_file, usecols=lambda c: c.strip() == column_name,
+                             engine="c", chunksize=CSV_CHUNK_ROWS)
+        column_found = False
+        first_reach_3 = None
+        accuracy_drops = False
+        offset = 0
+        plot_x, plot_y = [], []
+        for chunk in reader:
+            if chunk.shape[1] == 0:
+                break
+            column_found = True
+            # Coerce per chunk so a stray non-numeric cell becomes NaN instead of failing the read
+            col = pd.to_numeric(chunk.iloc[:, 0], errors="coerce").to_numpy(dtype=np.float32)
+            start = 0
+            if first_reach_3 is None:
+                reached_3 = col == 3
+                if reached_3.any():
+                    start = int(reached_3.argmax()) + 1
+                    first_reach_3 = offset + start - 1
+            if first_reach_3 is not None and not accuracy_drops:
+                tail = col[start:]
+                # Accuracy is an integer 0-3, so a range check stands in for isin((0, 1, 2))
+                accuracy_drops = bool(((tail >= 0) & (tail <= 2)).any())
+            # Min/max per bucket, drawn as a vertical segment at the bucket start; fmin/fmax skip NaN cells
+            if len(col):
+                starts = np.arange(0, len(col), PLOT_BUCKET)
+                plot_x.append(np.repeat(offset + starts, 2))
+                plot_y.append(np.column_stack((np.fmin.reduceat(col, starts), np.fmax.reduceat(col, starts))).ravel())
+            offset += len(col)
+        if column_found:
             print(f"Generating HTML plot for {column_name}...")
+            plot_x = np.concatenate(plot_x) if plot_x else np.empty(0, dtype=np.int64)
+            plot_y = np.concatenate(plot_y) if plot_y else np.empty(0, dtype=np.float32)
             fig = go.Figure()
-            fig.add_trace(go.Scatter(
-                x=df.index, 
-                y=df[column_name],
+            fig.add_trace(go.Scattergl(
+                x=plot_x,
+                y=plot_y,
                 mode='lines',
                 name=column_name,
                 line=dict(color='blue')
@@ -142,8 +183,6 @@ class BLEHandler:
                 yaxis_title="Accel Corrected 0.a",
                 template="plotly_white"
             )
-            first_reach_3 = df[df[column_name] == 3].index.min()
-            accuracy_drops = df.loc[first_reach_3:, column_name].isin([0, 1, 2]).any()
             if first_reach_3 is not None and not accuracy_drops:
                 pass_status = "PASS"
             else:
@@ -154,15 +193,17 @@ class BLEHandler:
                 f.write(f"<h2>Test Status: {pass_status}</h2>")
             print(f"Plot saved as {html_file} with test result: {pass_status}.")
         else:
-            print(f"Column '{column_name}' or '{column_name}' not found in the CSV file.")
-        return df
+            print(f"Column '{column_name}' not found in the CSV file.")
+            pass_status = None
+        return pass_status
 
     async def run(self):
         try:
             await self.log_data()
             bin_file = await self.read_large_binary_file("jj.bin")
-            self.clean_bin_file(bin_file)
-            csv_file = self.convert_bin_to_csv(bin_file)
+            # The device is done; disconnect while the file is cleaned and converted
+            csv_file, _ = await asyncio.gather(self.process_bin_file(bin_file), self.client.disconnect())
+            print("Disconnected from device.")
             self.validate_csv(csv_file)
         except BleakError as e:
             print(f"Error: {e}")
@@ -172,6 +213,7 @@ class BLEHandler:
                 print("Disconnected from device.")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
     BLE_MAC_ADDRESS = "FE:5F:42:38:8C:C0"
     handler = BLEHandler(BLE_MAC_ADDRESS)
     try:
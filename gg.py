@@ -1,5 +1,6 @@
 import asyncio 
 from bleak import BleakClient, BleakError
+from connection_pool import negotiate_mtu
 import time
 
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e" # BLE UUID
@@ -7,6 +8,21 @@ NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUI
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+ACK_TOKEN = "Executing"  # Text the device prints when it starts running a command
+ACK_TIMEOUT = 0.5  # Max seconds to wait for the ack before sending the next command
+ACTIVATE_COMMAND = "actse"  # Sensor activations are independent and can be sent back to back
+ACCURACY_TOKEN = b"Accuracy"  # Present in every calibration accuracy notification
+GYRO_PREFIX = "Gyro Accuracy"  # Notification carrying the gyro calibration accuracy (0-3)
+ACCEL_PREFIX = "Accel Accuracy"  # Notification carrying the accel calibration accuracy (0-3)
+
+
+def encode_command(command, write_len=BLE_GATT_WRITE_LEN):
+    """
+    Encode a command with its trailing newline and split it into fragments of at most write_len bytes.
+    """
+    payload = (command + '\n').encode()
+    return tuple(payload[i:i + write_len] for i in range(0, len(payload), write_len))
+
 
 class BLEConfigurator:
     """
@@ -16,6 +32,9 @@ class BLEConfigurator:
     def __init__(self, address):
         self.address = address
         self.response_log = [] 
+        self.write_len = BLE_GATT_WRITE_LEN  # Raised by negotiate_mtu once connected
+        self.ack = asyncio.Event()
+        self.acks_pending = 0  # Acks still owed for the commands in the last send
         self.popup_root = None
         self.commands = [
             "crt",                  # Command to trigger crt
@@ -24,6 +43,7 @@ class BLEConfigurator:
             "actse 52 100",         # Command to create log file
             "actse 54 100"          # Command to activate gyroscope corrected sensor
         ]
+        self.encoded_commands = {command: encode_command(command) for command in self.commands}  # Fragments built once
         self.gyro_calibration_start_time = None
         self.gyro_calibration_end_time = None
         self.accel_calibration_complete = False
@@ -37,18 +57,24 @@ class BLEConfigurator:
         decoded_data = data.decode('utf-8').strip()
         print(f"[Received from {sender}]: {decoded_data}")
         self.response_log.append(decoded_data)
+        if ACK_TOKEN in decoded_data:
+            # A batched send runs several commands; wait for one ack per command
+            self.acks_pending -= decoded_data.count(ACK_TOKEN)
+            if self.acks_pending <= 0:
+                self.ack.set()
+        if ACCURACY_TOKEN not in data:
+            return
         
-        if "Accel Accuracy" in decoded_data:
-            accuracy = int(decoded_data.split()[-1])
+        if decoded_data.startswith(ACCEL_PREFIX):
+            accuracy = int(decoded_data.rsplit(None, 1)[-1])
             if accuracy == 1:
                 print("Accel accuracy 1 reached. Place each axis of the device flat on the table for 3-4 seconds.")
             elif accuracy == 3:
                 print("Accel accuracy 3 reached. Calibration complete.")
                 self.accel_calibration_complete = True
-
         # Checking for gyroscope calibration accuracy and track time
-        if "Gyro Accuracy" in decoded_data:
-            accuracy = int(decoded_data.split()[-1])
+        elif decoded_data.startswith(GYRO_PREFIX):
+            accuracy = int(decoded_data.rsplit(None, 1)[-1])
             if accuracy == 1 and self.gyro_calibration_start_time is None:
                 # Recorded start time when Gyro Accuracy reaches 1
                 self.gyro_calibration_start_time = time.time()
@@ -69,26 +95,49 @@ class BLEConfigurator:
             await self.disconnect_device()
         return
 
+    async def wait_for_ack(self):
+        """
+        Wait until the device acks the last command, or ACK_TIMEOUT for devices that stay silent.
+        """
+        try:
+            await asyncio.wait_for(self.ack.wait(), timeout=ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
     async def send_command(self, client, command):
         """
         Send a single command to the BLE device.
         """
         print(f"[Sending to {self.address[-5:]}]: {command}")
-        if len(command) <= BLE_GATT_WRITE_LEN:
-            await client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        else:
-            for i in range(0, len(command), BLE_GATT_WRITE_LEN):
-                await client.write_gatt_char(NUS_RX_UUID, command[i:i + BLE_GATT_WRITE_LEN].encode())
-        
-        # Waiting briefly to allow the BLE device to process and respond
-        await asyncio.sleep(0.5)
+        self.acks_pending = 1
+        self.ack.clear()
+        fragments = self.encoded_commands.get(command) or encode_command(command, self.write_len)
+        for fragment in fragments:
+            await client.write_gatt_char(NUS_RX_UUID, fragment, response=False)
+        await self.wait_for_ack()
+
+    async def send_commands(self, client, commands):
+        """
+        Send independent commands back to back and wait once for all of their acks.
+        """
+        self.acks_pending = len(commands)
+        self.ack.clear()
+        for command in commands:
+            print(f"[Sending to {self.address[-5:]}]: {command}")
+            fragments = self.encoded_commands.get(command) or encode_command(command, self.write_len)
+            for fragment in fragments:
+                await client.write_gatt_char(NUS_RX_UUID, fragment, response=False)
+        await self.wait_for_ack()
 
     async def configure_device(self, client):
         """
         Send configuration commands to the BLE device.
         """
+        activations = [command for command in self.commands if command.startswith(ACTIVATE_COMMAND)]
         for command in self.commands:
-            await self.send_command(client, command)
+            if not command.startswith(ACTIVATE_COMMAND):
+                await self.send_command(client, command)
+        await self.send_commands(client, activations)
 
     async def continuous_stream(self, client):
         """
@@ -120,6 +169,8 @@ class BLEConfigurator:
             await self.client.connect()
             if self.client.is_connected:
                 print(f"Connected to {self.address[-5:]} ({self.address})")
+                self.write_len = await negotiate_mtu(self.client)
+                self.encoded_commands = {command: encode_command(command, self.write_len) for command in self.commands}
 
                 # Starting to receiving notifications
                 await self.client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
@@ -1,14 +1,28 @@
 import asyncio
+import collections
+import re
 from bleak import BleakClient, BleakError
+from connection_pool import negotiate_mtu
 import time
 import tkinter as tk
-from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import uvloop
+except ImportError:  # Not available on Windows, where asyncio already uses the proactor loop
+    uvloop = None
 
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"  # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+POPUP_REFRESH = 0.05  # Seconds between Tk event pumps while a popup is open
+ACK_TOKEN = "Executing"  # Text the device prints when it starts running a command
+ACK_TIMEOUT = 0.5  # Max seconds to wait for the ack before sending the next command
+RESPONSE_LOG_LEN = 256  # Most recent notifications kept for post-mortem inspection
+GYRO_PREFIX = "Gyro Accuracy"  # Notification carrying the gyro calibration accuracy (0-3)
+ACCEL_PREFIX = "Accel Accuracy"  # Notification carrying the accel calibration accuracy (0-3)
+ACCURACY_RE = re.compile("|".join(map(re.escape, (GYRO_PREFIX, ACCEL_PREFIX))))  # Finds either accuracy label in one pass
 
 class BLEConfigurator:
     """
@@ -17,7 +31,11 @@ class BLEConfigurator:
 
     def __init__(self, address):
         self.address = address
-        self.response_log = []
+        self.response_log = collections.deque(maxlen=RESPONSE_LOG_LEN)
+        self.write_len = BLE_GATT_WRITE_LEN  # Raised by negotiate_mtu once connected
+        self.ack = asyncio.Event()
+        self.acks_pending = 0  # Acks still owed for the commands in the last send
+        self.write_response = True  # Cleared when RX accepts write-without-response
         self.commands = [
             "crt",                  
             "-f l",                 
@@ -28,9 +46,10 @@ class BLEConfigurator:
         self.gyro_calibration_end_time = None
         self.popup_active = False
         self.popup_root = None
+        self.popup_task = None
+        self.button_tasks = set()  # Commands started from Tk callbacks; the loop only holds tasks weakly
         self.heading_test_started = False
-        self.executor = ThreadPoolExecutor()
-        self.loop = None
+        self.stop = asyncio.Event()  # Set once the heading test has ended or the link drops
         self.client = None
 
     def show_popup(self):
@@ -47,7 +66,38 @@ class BLEConfigurator:
         self.start_button.pack(pady=10)
         self.stop_button = tk.Button(self.popup_root, text="Stop", command=self.stop_heading, state="disabled")
         self.stop_button.pack(pady=10)
-        self.popup_root.mainloop()
+        # Pump Tk from the event loop so the buttons can schedule BLE writes on it directly
+        self.popup_task = asyncio.create_task(self.pump_popup())
+
+    async def pump_popup(self):
+        """
+        Keep the pop-up responsive by processing Tk events from the asyncio loop.
+        """
+        while self.popup_active:
+            try:
+                self.popup_root.update()
+            except tk.TclError:
+                # Window was closed by the user
+                self.popup_active = False
+                self.popup_root = None
+                break
+            await asyncio.sleep(POPUP_REFRESH)
+
+    def run_from_button(self, coro):
+        """
+        Schedule coro from a Tk callback, holding the task until it finishes and reporting any error.
+        """
+        task = asyncio.create_task(coro)
+        self.button_tasks.add(task)
+        task.add_done_callback(self.button_task_done)
+
+    def button_task_done(self, task):
+        """
+        Drop a finished button task and surface the error it failed with, if any.
+        """
+        self.button_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Button command failed: {task.exception()}")
 
     def start_heading(self):
         """
@@ -55,7 +105,7 @@ class BLEConfigurator:
         """
         print("Sending 'lab start_heading' command to BLE device...")
         if self.client:
-            asyncio.run_coroutine_threadsafe(self.send_command(self.client, "lab start_heading"), self.loop)
+            self.run_from_button(self.send_command(self.client, "lab start_heading"))
             self.start_button.config(state="disabled")
             self.stop_button.config(state="normal")
 
@@ -65,10 +115,23 @@ class BLEConfigurator:
         """
         print("Sending 'lab end_heading' command to BLE device...")
         if self.client:
-            asyncio.run_coroutine_threadsafe(self.send_command(self.client, "lab end_heading"), self.loop)
+            self.run_from_button(self.end_heading())
             self.stop_button.config(state="disabled")
             self.close_popup()
 
+    async def end_heading(self):
+        """
+        Send 'lab end_heading' and then let continuous_stream return.
+        """
+        await self.send_command(self.client, "lab end_heading")
+        self.stop.set()
+
+    def on_disconnect(self, client):
+        """
+        Called by Bleak when the link drops, whether we closed it or the device did.
+        """
+        self.stop.set()
+
     def close_popup(self):
         """
         Close the pop-up after stopping the heading test.
@@ -84,41 +147,63 @@ class BLEConfigurator:
         decoded_data = data.decode('utf-8').strip()
         print(f"Received: {decoded_data}")
         self.response_log.append(decoded_data)
-        if "Gyro Accuracy" in decoded_data:
-            accuracy = int(decoded_data.split()[-1])
+        if ACK_TOKEN in decoded_data:
+            # A burst runs several commands; wait for one ack per command
+            self.acks_pending -= decoded_data.count(ACK_TOKEN)
+            if self.acks_pending <= 0:
+                self.ack.set()
+        match = ACCURACY_RE.search(decoded_data)
+        if match is None:
+            return
+        accuracy = int(decoded_data.rsplit(None, 1)[-1])
+        if match.group() == GYRO_PREFIX:
             if accuracy == 1 and self.gyro_calibration_start_time is None:
-                self.gyro_calibration_start_time = time.time()
+                self.gyro_calibration_start_time = time.monotonic()
                 print("Gyroscope calibration started...")
             elif accuracy == 3 and self.gyro_calibration_start_time is not None:
-                self.gyro_calibration_end_time = time.time()
+                self.gyro_calibration_end_time = time.monotonic()
                 calibration_time = self.gyro_calibration_end_time - self.gyro_calibration_start_time
                 print(f"Gyroscope calibration completed. Time taken: {calibration_time:.2f} seconds.")
                 self.gyro_calibration_start_time = None
-        if "Accel Accuracy" in decoded_data:
-            accuracy = int(decoded_data.split()[-1])
+        else:
             if accuracy == 3:
                 print("Accelerometer calibration completed.")
                 if not self.popup_active:
-                    self.executor.submit(self.show_popup)
+                    self.show_popup()
+
+    async def wait_for_ack(self):
+        """
+        Wait until the device acks the last command, or ACK_TIMEOUT for devices that stay silent.
+        """
+        try:
+            await asyncio.wait_for(self.ack.wait(), timeout=ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
 
     async def send_command(self, client, command):
         """
         Send a single command to the BLE device.
         """
-        print(f"[Sending to {self.address[-5:]}]: {command}")
-        if len(command) <= BLE_GATT_WRITE_LEN:
-            await client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        else:
-            for i in range(0, len(command), BLE_GATT_WRITE_LEN):
-                await client.write_gatt_char(NUS_RX_UUID, command[i:i + BLE_GATT_WRITE_LEN].encode())
-        await asyncio.sleep(0.5)
+        await self.send_commands(client, [command])
+
+    async def send_commands(self, client, commands):
+        """
+        Send commands as one newline-separated burst of writes and wait once for all of their acks.
+        """
+        for command in commands:
+            print(f"[Sending to {self.address[-5:]}]: {command}")
+        payload = memoryview(("\n".join(commands) + "\n").encode())
+        self.acks_pending = len(commands)
+        self.ack.clear()
+        for i in range(0, len(payload), self.write_len):
+            await client.write_gatt_char(NUS_RX_UUID, payload[i:i + self.write_len], response=self.write_response)
+        await self.wait_for_ack()
 
     async def configure_device(self, client):
         """
         Send configuration commands to the BLE device.
         """
-        for command in self.commands:
-            await self.send_command(client, command)
+        await self.send_commands(client, self.commands)
 
     async def continuous_stream(self, client):
         """
@@ -126,8 +211,7 @@ class BLEConfigurator:
         """
         print(f"Entering continuous receive mode for {self.address[-5:]}")
         try:
-            while True:
-                await asyncio.sleep(5)
+            await self.stop.wait()
         except asyncio.CancelledError:
             print("Continuous receive mode interrupted.")
 
@@ -135,14 +219,16 @@ class BLEConfigurator:
         """
         Main function to connect to the BLE device, send commands, and stream data.
         """
-        self.loop = asyncio.get_running_loop()
-        self.client = BleakClient(self.address)
+        self.client = BleakClient(self.address, disconnected_callback=self.on_disconnect)
         try:
             # Connecting to the BLE device
             await self.client.connect()
             if self.client.is_connected:
                 print(f"Connected to {self.address[-5:]} ({self.address})")
+                self.write_len = await negotiate_mtu(self.client)
                 await self.client.start_notify(NUS_TX_UUID, self.nus_data_rcv_handler)
+                rx_char = self.client.services.get_characteristic(NUS_RX_UUID)
+                self.write_response = "write-without-response" not in rx_char.properties
                 print("Sending configuration commands...")
                 await self.configure_device(self.client)
                 await self.continuous_stream(self.client)
@@ -160,7 +246,8 @@ class BLEConfigurator:
 if __name__ == "__main__":
     BLE_MAC_ADDRESS = "E4:6E:C1:3A:91:F8"
     configurator = BLEConfigurator(BLE_MAC_ADDRESS)
+    run = asyncio.run if uvloop is None else uvloop.run  # uvloop.install() is deprecated
     try:
-        asyncio.run(configurator.run())
+        run(configurator.run())
     except asyncio.CancelledError:
         print("Configuration process was interrupted.")
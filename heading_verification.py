@@ -1,22 +1,68 @@
 import asyncio
 import os
-import re
-import subprocess
 import math
 import pandas as pd
 from bleak import BleakClient, BleakError
+from connection_pool import CONNECT_SEMAPHORE, negotiate_mtu, receive_file
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:  # Fall back to the pandas CSV reader
+    pa = pacsv = None
+
+try:
+    import uvloop
+except ImportError:  # Not available on Windows, where asyncio already uses the proactor loop
+    uvloop = None
 
 BLE_NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"  # BLE UUID
 NUS_RX_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"  # Write characteristic UUID
 NUS_TX_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"  # Notify characteristic UUID
 
 BLE_GATT_WRITE_LEN = 20  # Max length for GATT write operations
+BLE_CONN_INTERVAL = 0.02  # Approximate BLE connection interval in seconds
+
+# Header that marks the start of valid sensor data in the .bin file: "1.0", whitespace, then these fields in order
+HEADER_VERSION = b"1.0"
+HEADER_FIELDS = (b"1: Accelerometer (g):", b"2: Gyroscope (dps):", b"3: IMU Temperature (C):")
+
+
+def find_header(content):
+    """
+    Return the offset of the data header in content, or -1 if it is not there.
+    """
+    i = content.find(HEADER_FIELDS[0])
+    while i >= 0:
+        start = content.rfind(HEADER_VERSION, 0, i)
+        if start >= 0 and content[start + len(HEADER_VERSION):i].isspace():
+            pos = i
+            for field in HEADER_FIELDS[1:]:
+                pos = content.find(field, pos)
+                if pos < 0:
+                    return -1
+            return start
+        i = content.find(HEADER_FIELDS[0], i + 1)
+    return -1
+
+
+def first_value_after(values, mask):
+    """
+    Return (index, value) of the first non-NaN value after the first row where mask is set, or (None, None).
+    """
+    if not mask.any():
+        return None, None
+    following = values.iloc[mask.to_numpy().argmax() + 1:].dropna()
+    if following.empty:
+        return None, None
+    return following.index[0], float(following.iloc[0])
 
 
 class BLEFileHandler:
-    def __init__(self, address):
+    def __init__(self, address, output_dir="output"):
         self.address = address
-        self.output_dir = "output"
+        self.write_len = BLE_GATT_WRITE_LEN  # Raised by negotiate_mtu once connected
+        self.output_dir = output_dir
         os.makedirs(self.output_dir, exist_ok=True)
 
     async def send_command(self, client, command):
@@ -24,67 +70,24 @@ class BLEFileHandler:
         Send a command to the BLE device.
         """
         print(f"[Sending to {self.address[-5:]}]: {command}")
-        if len(command) <= BLE_GATT_WRITE_LEN:
-            await client.write_gatt_char(NUS_RX_UUID, (command + '\n').encode())
-        else:
-            for i in range(0, len(command), BLE_GATT_WRITE_LEN):
-                await client.write_gatt_char(NUS_RX_UUID, command[i:i + BLE_GATT_WRITE_LEN].encode())
-        await asyncio.sleep(0.5)
+        rx_char = client.services.get_characteristic(NUS_RX_UUID)
+        response = "write-without-response" not in rx_char.properties
+        payload = memoryview((command + '\n').encode())
+        for i in range(0, len(payload), self.write_len):
+            await client.write_gatt_char(NUS_RX_UUID, payload[i:i + self.write_len], response=response)
+        # No notification handler is active here to see an ack, so only give the link one interval
+        await asyncio.sleep(BLE_CONN_INTERVAL)
 
     async def read_large_binary_file(self, client, file_name, max_size_mb=10):
         """
         Read a large binary file (up to max_size_mb) from the BLE device via notifications.
         """
-        max_size_bytes = max_size_mb * 1024 * 1024  
         local_path = os.path.join(self.output_dir, file_name)
-        file_data = bytearray()
-
-        def notification_handler(sender, data):
-            nonlocal file_data
-            decoded_data = data.decode(errors="ignore").strip()
-            if not decoded_data.startswith(("rd", "Executing rd")):
-                file_data.extend(data)
-                print(f"Received {len(data)} bytes of file data. Total: {len(file_data)} bytes.")
-            else:
-                print(f"Filtered out log message: {decoded_data}")
         print(f"Requesting file {file_name} from BLE device...")
-        await client.start_notify(NUS_TX_UUID, notification_handler)
-        await client.write_gatt_char(NUS_RX_UUID, f"rd {file_name}\n".encode())
-        timeout = 30
-        for _ in range(timeout):
-            await asyncio.sleep(1)
-            if len(file_data) >= max_size_bytes:
-                print(f"File transfer limit of {max_size_mb} MB reached. Stopping...")
-                break
-        await client.stop_notify(NUS_TX_UUID)
-        with open(local_path, "wb") as f:
-            f.write(file_data)
-        print(f"File saved to {local_path} ({len(file_data)} bytes received)")
+        self.total_bytes = await receive_file(client, local_path, file_name, max_size_mb=max_size_mb, find_header=find_header)
         return local_path
 
-    def clean_bin_file(self, bin_file):
-        """
-        Cleans the .bin file by removing all content before the valid data header.
-        """
-        print(f"Cleaning binary file: {bin_file}...")
-        with open(bin_file, "rb") as f:
-            content = f.read()
-        decoded_content = content.decode(errors="ignore")
-        match = re.search(
-            r"1\.0\s+1: Accelerometer \(g\):.*?2: Gyroscope \(dps\):.*?3: IMU Temperature \(C\):", 
-            decoded_content,
-            re.DOTALL
-        )
-        if match:
-            valid_start = match.start()
-            valid_content = content[valid_start:]
-            with open(bin_file, "wb") as f:
-                f.write(valid_content)
-            print("Binary file cleaned successfully.")
-        else:
-            raise ValueError("Valid header not found in the binary file. File might be corrupted.")
-
-    def convert_bin_to_csv(self, bin_file):
+    async def convert_bin_to_csv(self, bin_file):
         """
         Convert the binary file to CSV using udf2csv.exe.
         """
@@ -94,14 +97,15 @@ class BLEFileHandler:
             raise FileNotFoundError(f"udf2csv.exe not found in {os.getcwd()}")
         print(f"Converting {bin_file} to CSV using {exe_path}...")
         try:
-            # Use subprocess to run udf2csv.exe
-            result = subprocess.run(
-                [exe_path, bin_file],
-                capture_output=True,
-                text=True
+            # Run udf2csv.exe without blocking the event loop; only stderr is needed, and only on failure
+            proc = await asyncio.create_subprocess_exec(
+                exe_path, bin_file,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
             )
-            if result.returncode != 0:
-                print(f"Error during conversion: {result.stderr}")
+            _, err = await proc.communicate()
+            if proc.returncode != 0:
+                print(f"Error during conversion: {err.decode(errors='ignore')}")
                 raise RuntimeError("Failed to convert .bin to .csv")
             print(f"CSV file created: {csv_file}")
             return csv_file
@@ -109,53 +113,49 @@ class BLEFileHandler:
             print(f"Error during conversion: {e}")
             raise
 
+    def read_columns(self, csv_file, columns):
+        """
+        Load only the given columns of the CSV as text, matching header names after stripping.
+        """
+        header = pd.read_csv(csv_file, nrows=0).columns
+        names = [col for col in header if col.strip() in columns]
+        if pacsv is not None:
+            # Explicit string types: inferring from the first block types a mostly blank column as null,
+            # and a non-numeric orientation cell would fail the parse instead of being coerced below
+            table = pacsv.read_csv(csv_file, convert_options=pacsv.ConvertOptions(
+                include_columns=names,
+                column_types={col: pa.string() for col in names}))
+            df = table.to_pandas(self_destruct=True)
+        else:
+            df = pd.read_csv(csv_file, usecols=names, dtype=str, engine="c")
+        df.columns = df.columns.str.strip()
+        return df
+
     def validate_csv(self, csv_file):
         """Validate the contents of the CSV file by loading it into a DataFrame"""
         print(f"Reading {csv_file} into a dataframe...")
-        df = pd.read_csv(csv_file)
-        df.columns = df.columns.str.strip()
         start_label = "start_heading"
         end_label = "end_heading"  
+        label_column = "Label data .l"
         orientation_column = "Orientation 0 (rad).h"
-        start_row = df[df['Label data .l'].str.contains(start_label, na=False)]
-        initial_value, final_value = None, None
-        if not start_row.empty:
-            start_index = start_row.index[0]
-            for i in range(start_index + 1, len(df)):
-                value = df.loc[i, orientation_column]
-                if pd.notna(value) and str(value).strip() != '':
-                    try:
-                        initial_value = float(value)
-                        print(f"Initial value set: {initial_value} at index {i}")
-                        break
-                    except ValueError:
-                        continue
-        end_row = df[df['Label data .l'].str.contains(end_label, na=False)]
-        if not end_row.empty:
-            end_index = end_row.index[0]
-            for i in range(end_index + 1, len(df)):
-                value = df.loc[i, orientation_column]
-                if pd.notna(value) and str(value).strip() != '':
-                    try:
-                        final_value = float(value)
-                        print(f"Final value set: {final_value} at index {i}")
-                        break
-                    except ValueError:
-                        continue  
+        df = self.read_columns(csv_file, (label_column, orientation_column))
+        labels = df[label_column]
+        # Blank or malformed cells become NaN, so the first valid reading is the first non-NaN one
+        orientation = pd.to_numeric(df[orientation_column].str.strip(), errors="coerce")
+        start_index, initial_value = first_value_after(orientation, labels.str.contains(start_label, na=False))
+        if initial_value is not None:
+            print(f"Initial value set: {initial_value} at index {start_index}")
+        end_index, final_value = first_value_after(orientation, labels.str.contains(end_label, na=False))
+        if final_value is not None:
+            print(f"Final value set: {final_value} at index {end_index}")
         print(f"Initial value: {initial_value}, Final value: {final_value}")
         if initial_value is not None and final_value is not None:
             initial_value_dps = initial_value * (180 / math.pi)
             final_value_dps = final_value * (180 / math.pi)
             print(f"Initial value in degrees: {initial_value_dps}°, Final value in degrees: {final_value_dps}°")
-            if initial_value_dps == 0:
-                initial_value_dps = 360
-            if final_value_dps == 0:
-                final_value_dps = 360
-            deviation = abs(((final_value_dps - initial_value_dps + 180) % 360) - 180)
-            print(f"Raw deviation: {deviation}°")
-            if deviation > 180:
-                deviation = 360 - deviation
-            print(f"Adjusted deviation: {deviation}°")
+            # Wrap the difference into [-180, 180]; 0° and 360° are the same heading
+            deviation = abs(math.remainder(final_value_dps - initial_value_dps, 360.0))
+            print(f"Deviation: {deviation}°")
             return initial_value_dps, final_value_dps, deviation
         else:
             print("Initial and/or final value is None. Deviation cannot be calculated.")
@@ -170,14 +170,16 @@ class BLEFileHandler:
         file_name = "0986.bin"  # Example file name
 
         try:
-            # Connect to the BLE device
-            await client.connect()
+            # Connect to the BLE device; BlueZ rejects a second connect while one is in progress on the adapter
+            async with CONNECT_SEMAPHORE:
+                await client.connect()
             if client.is_connected:
                 print(f"Connected to {self.address[-5:]} ({self.address})")
+                self.write_len = await negotiate_mtu(client)
                 bin_file = await self.read_large_binary_file(client, file_name)
-                self.clean_bin_file(bin_file)
-                csv_file = self.convert_bin_to_csv(bin_file)
-                self.validate_csv(csv_file)
+                csv_file = await self.convert_bin_to_csv(bin_file)
+                # Parse the CSV in a thread so other devices' transfers keep running
+                await asyncio.to_thread(self.validate_csv, csv_file)
         except BleakError as e:
             print(f"Error connecting to {self.address}: {e}")
         finally:
@@ -187,12 +189,23 @@ class BLEFileHandler:
                 print(f"Disconnected from {self.address[-5:]}.")
             
 
+async def run_all(handlers):
+    """
+    Read and process the file from every device concurrently on one event loop.
+    """
+    results = await asyncio.gather(*(handler.run() for handler in handlers), return_exceptions=True)
+    for handler, result in zip(handlers, results):
+        if isinstance(result, Exception):
+            print(f"Processing failed for {handler.address}: {result}")
+
+
 if __name__ == "__main__":
-    # BLE device MAC address
-    BLE_MAC_ADDRESS = "FE:5F:42:38:8C:C0"
+    # BLE device MAC addresses; each device gets its own subdirectory so file names cannot collide
+    BLE_MAC_ADDRESSES = ["FE:5F:42:38:8C:C0"]
 
-    handler = BLEFileHandler(BLE_MAC_ADDRESS)
+    handlers = [BLEFileHandler(mac, os.path.join("output", mac.replace(":", ""))) for mac in BLE_MAC_ADDRESSES]
+    run = asyncio.run if uvloop is None else uvloop.run  # uvloop.install() is deprecated
     try:
-        asyncio.run(handler.run())
+        run(run_all(handlers))
     except asyncio.CancelledError:
         print("File transfer process was interrupted.")